@@ -1,23 +1,38 @@
+import time
+BOOT_STARTED = time.perf_counter()   # 冷啟動計時從 import 之前開始
 import os
 import random
 import requests
 import threading
-import time
 import traceback
 import json
+import pickle
+import sqlite3
+import hashlib
+import re
+import sys
+import queue
+import heapq
+import atexit
+import itertools
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
-from bs4 import BeautifulSoup
 from flask import Flask, request, abort, jsonify
 from linebot import LineBotApi, WebhookHandler
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, 
     ImageMessage, ImageSendMessage, UnsendEvent, JoinEvent,
     FlexSendMessage, BubbleContainer, BoxComponent, TextComponent
 )
-from googletrans import Translator
 
 app = Flask(__name__)
+static_tmp_path = os.path.join(os.path.dirname(__file__), 'static', 'tmp')
+os.makedirs(static_tmp_path, exist_ok=True)
 
 # ==========================================
 # 👇 1. 請改成你的 Render 網址
@@ -28,57 +43,1154 @@ OWNER_ID = "U6d111042c6ecb593b8c6bb781417c45f"
 
 # 👇 3. 電腦控制台密碼
 API_PASSWORD = "0208"
+
+# 👇 4. 防收回暫存上限 (每群 / 全部 / 保留秒數 / 每群待抓數)
+MSG_STORE_PER_ROOM = int(os.environ.get('MSG_STORE_PER_ROOM', 300))
+MSG_STORE_MAX = int(os.environ.get('MSG_STORE_MAX', 20000))
+MSG_STORE_TTL = int(os.environ.get('MSG_STORE_TTL', 86400))
+UNSENT_BUFFER_MAX = int(os.environ.get('UNSENT_BUFFER_MAX', 20))
+
+# 👇 5. Webhook 背景處理 (先回 200 再慢慢跑；設 0 = 舊的同步模式)
+ASYNC_WEBHOOK = os.environ.get('ASYNC_WEBHOOK', '1') == '1'
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', 8))
+EVENT_QUEUE_MAX = int(os.environ.get('EVENT_QUEUE_MAX', 500))
+EVENT_QUEUE_TIMEOUT = float(os.environ.get('EVENT_QUEUE_TIMEOUT', 2))
+EVENT_DRAIN_TIMEOUT = float(os.environ.get('EVENT_DRAIN_TIMEOUT', 10))
+
+# 👇 6. 暱稱快取 (筆數 / 秒數 / 開通時是否預抓全群)
+NAME_CACHE_MAX = int(os.environ.get('NAME_CACHE_MAX', 5000))
+NAME_CACHE_TTL = int(os.environ.get('NAME_CACHE_TTL', 3600))
+NAME_PREFETCH = os.environ.get('NAME_PREFETCH', '0') == '1'
+
+# 👇 7. 翻譯 (快取筆數 / 秒數 / 逾時 / 連錯幾次就暫停 / 暫停秒數)
+TRANSLATE_CACHE_MAX = int(os.environ.get('TRANSLATE_CACHE_MAX', 2000))
+TRANSLATE_CACHE_TTL = int(os.environ.get('TRANSLATE_CACHE_TTL', 86400))
+TRANSLATE_TIMEOUT = float(os.environ.get('TRANSLATE_TIMEOUT', 3))
+TRANSLATE_FAIL_LIMIT = int(os.environ.get('TRANSLATE_FAIL_LIMIT', 3))
+TRANSLATE_COOLDOWN = int(os.environ.get('TRANSLATE_COOLDOWN', 60))
+
+# 👇 8. 金價/匯率/天氣 快取 (幾秒內算新鮮 / 最久可用舊資料 / 多久沒人問就不再背景更新)
+QUOTE_FRESH = int(os.environ.get('QUOTE_FRESH', 300))
+QUOTE_MAX_STALE = int(os.environ.get('QUOTE_MAX_STALE', 3600))
+QUOTE_KEEPALIVE = int(os.environ.get('QUOTE_KEEPALIVE', 3600))
+HTTP_TIMEOUT = (3, 10)
+HTTP_HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"}
+
+# 👇 9. 計時器 (開牌倒數 / 提醒後判輸 / 未授權自動退群 秒數，執行計時工作的執行緒數)
+ROUND_WARN_SECONDS = 15
+ROUND_EXPIRE_SECONDS = 5
+JOIN_LEAVE_SECONDS = 20
+TIMER_WORKERS = int(os.environ.get('TIMER_WORKERS', 4))
+
+# 👇 10. 圖片暫存 (保留秒數 / 單張上限 / 下載區塊 / 同時下載數 / 排隊上限)
+IMAGE_TTL = int(os.environ.get('IMAGE_TTL', 3600))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+IMAGE_CHUNK = 64 * 1024
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 4))
+IMAGE_QUEUE_MAX = int(os.environ.get('IMAGE_QUEUE_MAX', 100))
+
+# 👇 11. 狀態儲存 (memory = 單一 worker；sqlite = 多 worker 共用、重啟不掉資料)
+#        sqlite 時房間、名單、防收回文字、圖片索引都放 DB，收回事件落到哪個 worker 都找得到
+#        STATE_WRITE_BEHIND > 0 表示延遲幾秒批次寫入，只適合單一 worker
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+STATE_PATH = os.environ.get('STATE_PATH', os.path.join(os.path.dirname(__file__), 'state.db'))
+STATE_WRITE_BEHIND = float(os.environ.get('STATE_WRITE_BEHIND', 0))
+STATE_LOCK_STRIPES = 64
+ROOM_LOCK_STRIPES = int(os.environ.get('ROOM_LOCK_STRIPES', 256))
+
+# 👇 12. 莊家場次明細最多留幾筆 (0 = 只記輸贏總額，不留明細)
+SESSION_LOG_MAX = int(os.environ.get('SESSION_LOG_MAX', 200))
+
+# 👇 13. 公告廣播 (同時發送數 / 每秒上限 / 429、5xx 重試次數，廣播時取代 14. 的 LINE_API_RETRIES)
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 8))
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 100))
+BROADCAST_RETRIES = int(os.environ.get('BROADCAST_RETRIES', 3))
+
+# 👇 14. LINE API 連線 (連線/讀取逾時、暫時性錯誤重試次數、連線池大小)
+LINE_API_TIMEOUT = (float(os.environ.get('LINE_CONNECT_TIMEOUT', 3)), float(os.environ.get('LINE_READ_TIMEOUT', 10)))
+LINE_API_RETRIES = int(os.environ.get('LINE_API_RETRIES', 2))
+LINE_API_POOL = int(os.environ.get('LINE_API_POOL', 32))
+
+# 👇 15. /metrics (Prometheus 格式；有設 METRICS_TOKEN 就要帶 Bearer token)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# 👇 16. 冷啟動 (LAZY_STARTUP=1：googletrans/bs4、LINE client、背景執行緒延後到第一次用到或開機後 WARMUP_DELAY 秒)
+LAZY_STARTUP = os.environ.get('LAZY_STARTUP', '1') == '1'
+WARMUP_DELAY = float(os.environ.get('WARMUP_DELAY', 10))
+
+# 👇 17. 洗版防護 (範圍=每秒補幾次/最多累積幾次；user/room 管所有指令和翻譯，translate/scrape/game 是每人每類指令另外限)
+#        被擋時每人幾秒最多提醒一次 (0 = 直接丟掉不回)；幾秒內被擋幾次自動進黑名單 (0 = 不自動封)
+FLOOD_LIMITS = os.environ.get('FLOOD_LIMITS', 'user=1/10,room=5/40,translate=0.2/4,scrape=0.1/3,game=2/10')
+FLOOD_NOTICE_SECONDS = int(os.environ.get('FLOOD_NOTICE_SECONDS', 30))
+FLOOD_BAN_STRIKES = int(os.environ.get('FLOOD_BAN_STRIKES', 0))
+FLOOD_BAN_WINDOW = int(os.environ.get('FLOOD_BAN_WINDOW', 300))
+FLOOD_TRACK_MAX = int(os.environ.get('FLOOD_TRACK_MAX', 20000))
+
+# 👇 18. Webhook 去重 (webhookEventId 記幾秒 / 最多記幾筆；LINE 標了 isRedelivery 的事件：dedup = 沒處理過才處理、drop = 一律丟掉)
+EVENT_DEDUP_TTL = int(os.environ.get('EVENT_DEDUP_TTL', 3600))
+EVENT_DEDUP_MAX = int(os.environ.get('EVENT_DEDUP_MAX', 50000))
+REDELIVERY_MODE = os.environ.get('REDELIVERY_MODE', 'dedup')
 # ==========================================
 
+# --- 🚀 冷啟動計時：各階段花多久、延後載入的東西第一次用到花多久 ---
+class StartupClock:
+    def __init__(self, started):
+        self.lock = threading.Lock(); self.last = started; self.started = started
+        self.phases = OrderedDict(); self.lazy = OrderedDict(); self.ready_at = None
+
+    def mark(self, phase):
+        now = time.perf_counter(); self.phases[phase] = now - self.last; self.last = now
+
+    def ready(self):
+        self.ready_at = time.perf_counter()
+        print("🚀 startup " + " ".join(f"{k}={v * 1000:.0f}ms" for k, v in self.phases.items()) + f" total={(self.ready_at - self.started) * 1000:.0f}ms lazy={LAZY_STARTUP}")
+
+    def loaded(self, name, seconds):
+        with self.lock: self.lazy[name] = seconds
+
+    def stats(self):
+        with self.lock: lazy = {k: round(v * 1000, 1) for k, v in self.lazy.items()}
+        return {"lazy_mode": LAZY_STARTUP, "phases_ms": {k: round(v * 1000, 1) for k, v in self.phases.items()},
+                "total_ms": round((self.ready_at - self.started) * 1000, 1) if self.ready_at else None, "lazy_loaded_ms": lazy}
+
+startup = StartupClock(BOOT_STARTED); startup.mark('imports')
+
+class Lazy:
+    # 第一次用到才建；屬性讀寫都轉給真正的物件，呼叫端照舊寫 line_bot_api.xxx
+    def __init__(self, name, factory):
+        object.__setattr__(self, '_name', name); object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_obj', None); object.__setattr__(self, '_lock', threading.Lock())
+
+    def get(self):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    started = time.perf_counter(); object.__setattr__(self, '_obj', self._factory())
+                    startup.loaded(self._name, time.perf_counter() - started)
+        return self._obj
+
+    def __getattr__(self, attr): return getattr(self.get(), attr)
+    def __setattr__(self, attr, value): setattr(self.get(), attr, value)
+
 # 設定金鑰
 token = os.environ.get('CHANNEL_ACCESS_TOKEN')
 secret = os.environ.get('CHANNEL_SECRET')
-line_bot_api = LineBotApi(token)
+
+# --- 📡 LINE API 連線：keep-alive 連線池 + 逾時 + 暫時性錯誤重試 + 每個 endpoint 計時 ---
+LINE_ID_RE = re.compile(r'/(?:[UCR][0-9a-f]{32}|\d+)(?=/|$)')
+LINE_RETRY_KEY_PATHS = ('/v2/bot/message/push', '/v2/bot/message/multicast', '/v2/bot/message/narrowcast', '/v2/bot/message/broadcast')
+
+class LineApiStats:
+    def __init__(self):
+        self.lock = threading.Lock(); self.data = {}   # endpoint -> [次數, 總秒數, 最慢秒數, 錯誤數, 重試數]
+
+    def record(self, endpoint, seconds, error=False, retried=False):
+        metrics.observe('linebot_outbound_seconds', seconds, dependency='line', endpoint=endpoint)
+        if error: metrics.inc('linebot_outbound_errors_total', dependency='line', endpoint=endpoint)
+        with self.lock:
+            rec = self.data.setdefault(endpoint, [0, 0.0, 0.0, 0, 0])
+            rec[0] += 1; rec[1] += seconds; rec[2] = max(rec[2], seconds); rec[3] += error; rec[4] += retried
+
+    def snapshot(self):
+        with self.lock:
+            return {ep: {"calls": c, "avg_ms": round(t / c * 1000, 1), "max_ms": round(m * 1000, 1), "errors": e, "retries": r}
+                    for ep, (c, t, m, e, r) in self.data.items() if c}
+
+line_api_stats = LineApiStats()
+
+# 呼叫端可以指定這一次 LINE API 呼叫的 retry key / 重試次數 (例如廣播每個群固定一把 key)；
+# 重試只在 PooledHttpClient 這一層做，同一次呼叫的每次重試都帶同一把 key
+line_call = threading.local()
+
+@contextmanager
+def line_call_options(retry_key=None, retries=None):
+    opts = {'retry_key': retry_key, 'retries': retries, 'retried': 0}
+    prev = getattr(line_call, 'opts', None); line_call.opts = opts
+    try: yield opts
+    finally: line_call.opts = prev
+
+class AcceptedResponse(RequestsHttpResponse):
+    # 409 + 同一把 retry key：LINE 之前已經收下了，對呼叫端來說就是成功
+    status_code = 200
+    json = property(lambda self: {})
+
+class PooledHttpClient(RequestsHttpClient):
+    def __init__(self, timeout=LINE_API_TIMEOUT):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=LINE_API_POOL)
+        self.session.mount("https://", adapter); self.session.mount("http://", adapter)
+
+    def _request(self, method, url, headers=None, timeout=None, **kwargs):
+        path = requests.utils.urlparse(url).path; endpoint = f"{method} {LINE_ID_RE.sub('/{id}', path)}"
+        opts = getattr(line_call, 'opts', None) or {}
+        retries = LINE_API_RETRIES if opts.get('retries') is None else opts['retries']
+        keyed = method == 'POST' and path.startswith(LINE_RETRY_KEY_PATHS)
+        if keyed:
+            # 同一個 retry key，LINE 端重試時不會重複推播 (不用 SDK 的 retry_key 參數：它會把 key 永久留在共用 headers 裡)
+            headers = dict(headers or {}); headers['X-Line-Retry-Key'] = opts.get('retry_key') or str(uuid.uuid4())
+        for attempt in range(retries + 1):
+            started = time.time(); last = attempt == retries; res = None
+            try: res = self.session.request(method, url, headers=headers, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                line_api_stats.record(endpoint, time.time() - started, error=True, retried=not last)
+                if last: raise
+            else:
+                if keyed and res.status_code == 409: line_api_stats.record(endpoint, time.time() - started); return AcceptedResponse(res)
+                transient = res.status_code == 429 or res.status_code >= 500
+                line_api_stats.record(endpoint, time.time() - started, error=res.status_code >= 400, retried=transient and not last)
+                if not transient or last: return RequestsHttpResponse(res)
+            if opts: opts['retried'] += 1
+            if res is not None and res.headers.get('Retry-After', '').isdigit(): time.sleep(min(5, int(res.headers['Retry-After'])))
+            else: time.sleep(0.2 * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None): return self._request('GET', url, headers, timeout, params=params, stream=stream)
+    def post(self, url, headers=None, data=None, timeout=None): return self._request('POST', url, headers, timeout, data=data)
+    def delete(self, url, headers=None, data=None, timeout=None): return self._request('DELETE', url, headers, timeout, data=data)
+    def put(self, url, headers=None, data=None, timeout=None): return self._request('PUT', url, headers, timeout, data=data)
+
+line_bot_api = Lazy('line_bot_api', lambda: LineBotApi(token, timeout=LINE_API_TIMEOUT, http_client=PooledHttpClient))
 handler = WebhookHandler(secret)
 
-translator = Translator()
-message_store = {}
-static_tmp_path = os.path.join(os.path.dirname(__file__), 'static', 'tmp')
-os.makedirs(static_tmp_path, exist_ok=True)
-rooms_data = {}
+# 一次回覆最多 5 則，多的改用 push 每 5 則一包補送
+LINE_MAX_MESSAGES = 5
+
+# 事件屬於哪個對話 (群組 / 多人聊天室 / 私訊)：交易鎖、房間資料、push 對象都用這個，三者一定一致
+def event_source_id(event):
+    src = event.source
+    return src.group_id if src.type == 'group' else getattr(src, 'room_id', None) or src.user_id
+
+def reply_with_overflow(reply_token, to, messages):
+    if not isinstance(messages, list): messages = [messages]
+    line_bot_api.reply_message(reply_token, messages[:LINE_MAX_MESSAGES])
+    for i in range(LINE_MAX_MESSAGES, len(messages), LINE_MAX_MESSAGES):
+        line_bot_api.push_message(to, messages[i:i + LINE_MAX_MESSAGES])
+
+def _make_translator():
+    from googletrans import Translator   # 連同舊版 httpx 一起載，最重的一塊
+    return Translator(timeout=TRANSLATE_TIMEOUT)
+
+translator = Lazy('googletrans', _make_translator)
+startup.mark('line_client')
+
+# --- 📊 監控指標 (Prometheus 文字格式，不另外裝套件) ---
+class Metrics:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock(); self.counters = {}; self.hists = {}; self.help = {}
+
+    def describe(self, name, kind, text): self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.hists.get(key)
+            if h is None: h = self.hists[key] = [[0] * len(self.BUCKETS), 0, 0.0]
+            for i, b in enumerate(self.BUCKETS):
+                if seconds <= b: h[0][i] += 1
+            h[1] += 1; h[2] += seconds
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items: return ""
+        esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self, gauges):
+        out = []; seen = set()
+        def header(name, kind):
+            if name in seen: return
+            seen.add(name); k, text = self.help.get(name, (kind, name))
+            out.append(f"# HELP {name} {text}"); out.append(f"# TYPE {name} {k}")
+        with self.lock: counters = sorted(self.counters.items()); hists = sorted(self.hists.items())
+        for (name, labels), v in counters: header(name, "counter"); out.append(f"{name}{self._labels(labels)} {v}")
+        for (name, labels), (buckets, count, total) in hists:
+            header(name, "histogram")
+            for b, c in zip(self.BUCKETS, buckets): out.append(f"{name}_bucket{self._labels(labels, [('le', b)])} {c}")
+            out.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            out.append(f"{name}_sum{self._labels(labels)} {round(total, 6)}"); out.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, text, value, *labels in gauges:
+            self.help.setdefault(name, ("gauge", text)); header(name, "gauge")
+            out.append(f"{name}{self._labels(sorted(labels[0].items()) if labels else ())} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe('linebot_command_seconds', 'histogram', 'Text command handler latency')
+metrics.describe('linebot_event_seconds', 'histogram', 'Webhook event handling latency by event type')
+metrics.describe('linebot_outbound_seconds', 'histogram', 'Outbound call latency by dependency')
+metrics.describe('linebot_outbound_errors_total', 'counter', 'Outbound calls that raised or returned an error')
+metrics.describe('linebot_swallowed_exceptions_total', 'counter', 'Exceptions caught and ignored, by code site')
+metrics.describe('linebot_handler_errors_total', 'counter', 'Exceptions that escaped a webhook handler')
+metrics.describe('linebot_flood_dropped_total', 'counter', 'Commands and translations dropped by flood control, by limiting scope')
+metrics.describe('linebot_flood_bans_total', 'counter', 'Users auto-blacklisted by flood control')
+metrics.describe('linebot_webhook_dedup_total', 'counter', 'Webhook events skipped by deduplication, by reason')
+metrics.describe('linebot_webhook_redeliveries_total', 'counter', 'Webhook events LINE marked as redelivered')
+metrics.describe('linebot_events_rejected_total', 'counter', 'Webhook events refused because the worker queue was full')
+
+@contextmanager
+def timed(dependency, **labels):
+    started = time.time()
+    try: yield
+    except Exception: metrics.inc('linebot_outbound_errors_total', dependency=dependency, **labels); raise
+    finally: metrics.observe('linebot_outbound_seconds', time.time() - started, dependency=dependency, **labels)
+
+def swallowed(site): metrics.inc('linebot_swallowed_exceptions_total', site=site)
+
+# --- 🧠 防收回文字暫存 (每群 + 全域上限，最舊的先丟) ---
+class MessageStore:
+    def __init__(self, per_room, max_total, ttl):
+        self.per_room, self.max_total, self.ttl = per_room, max_total, ttl
+        self.lock = threading.Lock()
+        self.index = OrderedDict()   # msg_id -> room_id (全域新舊順序)
+        self.rooms = {}              # room_id -> OrderedDict(msg_id -> (ts, text))
+        self.bytes = 0
+
+    def _drop(self, msg_id):
+        room_id = self.index.pop(msg_id, None)
+        if room_id is None: return
+        bucket = self.rooms[room_id]; _, text = bucket.pop(msg_id); self.bytes -= sys.getsizeof(text)
+        if not bucket: del self.rooms[room_id]
+
+    def put(self, room_id, msg_id, text):
+        with self.lock:
+            self._drop(msg_id)
+            bucket = self.rooms.setdefault(room_id, OrderedDict())
+            bucket[msg_id] = (time.time(), text); self.index[msg_id] = room_id; self.bytes += sys.getsizeof(text)
+            while len(bucket) > self.per_room: self._drop(next(iter(bucket)))
+            while len(self.index) > self.max_total: self._drop(next(iter(self.index)))
+
+    def get(self, msg_id):
+        with self.lock:
+            room_id = self.index.get(msg_id)
+            if room_id is None: return None
+            ts, text = self.rooms[room_id][msg_id]
+            if time.time() - ts > self.ttl: self._drop(msg_id); return None
+            return text
+
+    def __contains__(self, msg_id): return self.get(msg_id) is not None
+    def __len__(self): return len(self.index)
+
+    def stats(self):
+        with self.lock:
+            return {"backend": "memory", "messages": len(self.index), "rooms": len(self.rooms), "text_bytes": self.bytes,
+                    "index_bytes": sys.getsizeof(self.index) + sum(sys.getsizeof(b) for b in self.rooms.values()),
+                    "per_room_cap": self.per_room, "global_cap": self.max_total, "ttl": self.ttl}
+
+# --- ✈️ 同一個 key 同時只讓一個執行緒去抓，其他人等結果 ---
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock(); self.calls = {}   # key -> [Event, 值, 例外]
+
+    def do(self, key, fn):
+        # 回傳 (值, 是否沿用別人的結果)
+        with self.lock:
+            call = self.calls.get(key); owner = call is None
+            if owner: call = self.calls[key] = [threading.Event(), None, None]
+        if not owner:
+            call[0].wait()
+            if call[2] is not None: raise call[2]
+            return call[1], True
+        try: call[1] = fn(); return call[1], False
+        except Exception as e: call[2] = e; raise
+        finally:
+            with self.lock: self.calls.pop(key, None)
+            call[0].set()
+
+# --- ⏳ TTL 快取 (同一個 key 同時只會有一個人去抓) ---
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl = maxsize, ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()   # key -> (到期時間, 值)
+        self.flight = SingleFlight()
+        self.hits = self.misses = self.coalesced = 0
+
+    def peek(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item and item[0] > time.time(): self.data.move_to_end(key); self.hits += 1; return item[1]
+        return None
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.data[key] = (time.time() + (ttl or self.ttl), value); self.data.move_to_end(key)
+            while len(self.data) > self.maxsize: self.data.popitem(last=False)
+
+    def get(self, key, loader):
+        value = self.peek(key)
+        if value is not None: return value
+        def load():
+            value = loader(); self.set(key, value); return value
+        value, shared = self.flight.do(key, load)
+        with self.lock:
+            if shared: self.coalesced += 1
+            else: self.misses += 1
+        return value
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses + self.coalesced
+            return {"size": len(self.data), "max": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses,
+                    "coalesced": self.coalesced, "hit_rate": round((self.hits + self.coalesced) / total, 3) if total else None}
+
+name_cache = TTLCache(NAME_CACHE_MAX, NAME_CACHE_TTL)
+
+# --- 🔌 斷路器 (連續失敗就先停一陣子，不要讓 webhook 卡在慢的服務上) ---
+class CircuitBreaker:
+    def __init__(self, fail_limit, cooldown):
+        self.fail_limit, self.cooldown = fail_limit, cooldown
+        self.lock = threading.Lock(); self.fails = 0; self.open_until = 0.0; self.trips = 0
+
+    def allow(self): return time.time() >= self.open_until
+
+    def record(self, ok):
+        with self.lock:
+            if ok: self.fails = 0; return
+            self.fails += 1
+            if self.fails >= self.fail_limit: self.open_until = time.time() + self.cooldown; self.fails = 0; self.trips += 1
+
+    def stats(self):
+        return {"open": not self.allow(), "fails": self.fails, "trips": self.trips, "retry_in": max(0, round(self.open_until - time.time(), 1))}
+
+# --- 📈 報價快取：過期先回舊值、背景再更新 (stale-while-revalidate) ---
+http = requests.Session()
+http.headers.update(HTTP_HEADERS)
+http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16))
+
+class QuoteCache:
+    def __init__(self, fresh, max_stale, keepalive):
+        self.fresh, self.max_stale, self.keepalive = fresh, max_stale, keepalive
+        self.lock = threading.Lock(); self.flight = SingleFlight()
+        self.data = {}      # key -> (抓取時間, 值)
+        self.loaders = {}   # key -> [loader, 最後被問的時間]
+        self.refreshing = set()   # 已經有背景執行緒在更新的 key
+        self.hits = self.stale_hits = self.fetches = self.errors = 0
+
+    def _refresh(self, key):
+        def load():
+            with self.lock: self.fetches += 1
+            try: value = self.loaders[key][0]()
+            except Exception:
+                with self.lock: self.errors += 1
+                raise
+            with self.lock: self.data[key] = (time.time(), value)
+            return value
+        return self.flight.do(key, load)[0]
+
+    def _refresh_quietly(self, key):
+        try: self._refresh(key)
+        except Exception: swallowed('quote_refresh')
+
+    def _refresh_background(self, key):
+        try: self._refresh_quietly(key)
+        finally:
+            with self.lock: self.refreshing.discard(key)
+
+    def get(self, key, loader):
+        now = time.time()
+        with self.lock:
+            self.loaders[key] = [loader, now]; item = self.data.get(key)
+            if item and now - item[0] < self.fresh: self.hits += 1; return item[1]
+            stale = item is not None and now - item[0] < self.max_stale
+            # 舊值先回；同一個 key 只開一條背景更新，洗版時不會每則訊息各開一條
+            spawn = stale and key not in self.refreshing
+            if stale: self.stale_hits += 1
+            if spawn: self.refreshing.add(key)
+        if spawn: threading.Thread(target=self._refresh_background, args=(key,), daemon=True).start()
+        if stale: return item[1]
+        return self._refresh(key)
+
+    def run_forever(self):
+        while True:
+            time.sleep(self.fresh)
+            now = time.time()
+            with self.lock:
+                for key in [k for k, (_, seen) in self.loaders.items() if now - seen > self.keepalive]:
+                    self.loaders.pop(key, None); self.data.pop(key, None)
+                keys = list(self.loaders)
+            for key in keys: self._refresh_quietly(key)
+
+    def stats(self):
+        with self.lock:
+            return {"keys": len(self.data), "hits": self.hits, "stale_hits": self.stale_hits, "fetches": self.fetches,
+                    "errors": self.errors, "fresh": self.fresh, "max_stale": self.max_stale}
+
+quote_cache = QuoteCache(QUOTE_FRESH, QUOTE_MAX_STALE, QUOTE_KEEPALIVE)
+geo_cache = TTLCache(500, 7 * 86400)
+
+@timed('scraper_gold')
+def fetch_gold_price():
+    from bs4 import BeautifulSoup
+    res = http.get("https://999k.com.tw/", timeout=HTTP_TIMEOUT); res.encoding = 'utf-8'
+    soup = BeautifulSoup(res.text, "html.parser")
+    for row in soup.find_all('tr'):
+        if "黃金賣出" in row.text.strip().replace('\n', '').replace(' ', ''):
+            for td in row.find_all('td'):
+                val = td.text.strip().replace(',', '')
+                if val.isdigit() and len(val) >= 4: return val
+    return None
+
+@timed('scraper_fx')
+def fetch_jpy_rate():
+    from bs4 import BeautifulSoup
+    res = http.get("https://rate.bot.com.tw/xrt?Lang=zh-TW", timeout=HTTP_TIMEOUT)
+    soup = BeautifulSoup(res.text, "html.parser")
+    for row in soup.find('tbody').find_all('tr'):
+        if "JPY" in row.text: return row.find_all('td')[2].text.strip()
+    return None
+
+def geocode(q):
+    @timed('scraper_geocode')
+    def load():
+        g = http.get("https://geocoding-api.open-meteo.com/v1/search", params={"name": q, "count": 1, "language": "zh", "format": "json"}, timeout=HTTP_TIMEOUT).json()
+        if "results" not in g: return ()
+        return g["results"][0]["latitude"], g["results"][0]["longitude"], g["results"][0]["name"]
+    return geo_cache.get(q, load)
+
+@timed('scraper_weather')
+def fetch_temperature(lat, lon):
+    w = http.get("https://api.open-meteo.com/v1/forecast", params={"latitude": lat, "longitude": lon, "current_weather": "true", "timezone": "auto"}, timeout=HTTP_TIMEOUT).json()
+    return w['current_weather']['temperature']
+
+# --- 🇹🇭 翻譯：本地先判斷有沒有泰文，有才送 googletrans ---
+THAI_RE = re.compile('[\u0e00-\u0e7f]')
+translation_cache = TTLCache(TRANSLATE_CACHE_MAX, TRANSLATE_CACHE_TTL)
+translate_breaker = CircuitBreaker(TRANSLATE_FAIL_LIMIT, TRANSLATE_COOLDOWN)
+
+def has_thai(text): return THAI_RE.search(text) is not None
+
+# 回傳 (來源語言, 譯文)；服務掛掉或斷路中會丟例外
+def translate_text(text, dest):
+    def load():
+        if not translate_breaker.allow(): raise RuntimeError("translator circuit open")
+        try:
+            with timed('googletrans'): res = translator.translate(text, dest=dest)
+        except Exception: translate_breaker.record(False); raise
+        translate_breaker.record(True); return res.src, res.text
+    return translation_cache.get((dest, text), load)
+
+# --- 🔒 房間鎖 (條紋 RLock：同一房間的 webhook/計時器排隊，不同房間平行) ---
+class RoomLocks:
+    def __init__(self, stripes, track=200):
+        self.locks = [threading.RLock() for _ in range(stripes)]
+        self.stat_lock = threading.Lock(); self.track = track
+        self.acquired = self.contended = 0; self.wait_total = 0.0
+        self.hot = OrderedDict()   # room_id -> [搶鎖次數, 等待毫秒]
+
+    @contextmanager
+    def hold(self, room_id):
+        lock = self.locks[hash(room_id) % len(self.locks)]; waited = None
+        if not lock.acquire(blocking=False):
+            started = time.time(); lock.acquire(); waited = time.time() - started
+        try:
+            with self.stat_lock:
+                self.acquired += 1
+                if waited is not None:
+                    self.contended += 1; self.wait_total += waited
+                    rec = self.hot.pop(room_id, [0, 0.0]); rec[0] += 1; rec[1] += waited * 1000; self.hot[room_id] = rec
+                    if len(self.hot) > self.track: self.hot.popitem(last=False)
+            yield
+        finally: lock.release()
+
+    def stats(self, top=10):
+        with self.stat_lock:
+            hot = sorted(self.hot.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+            return {"stripes": len(self.locks), "acquired": self.acquired, "contended": self.contended,
+                    "wait_total_ms": round(self.wait_total * 1000, 2),
+                    "hot_rooms": [{"room": rid, "contended": c, "wait_ms": round(w, 2)} for rid, (c, w) in hot]}
+
+room_locks = RoomLocks(ROOM_LOCK_STRIPES)
+
+# --- 💰 帳本：每筆寫入就更新兩兩淨額，!查帳 不用整本重算 ---
+class Ledger:
+    def __init__(self):
+        self.entries = []   # 完整明細 (分頁看)
+        self.pairs = {}     # (a, b) 且 a < b -> a 欠 b 的淨額 (負數 = b 欠 a)
+        self.cleared = 0    # 清空過幾次；存檔時用來判斷明細表要整本重寫還是只補新的
+
+    def extend(self, records):
+        for r in records: self.entries.append(r); self._apply(r['d'], r['c'], r['amt'])
+
+    def append(self, d, c, amt, note):
+        self.entries.append({'d': d, 'c': c, 'amt': amt, 'note': note, 'time': datetime.now().strftime("%H:%M")}); self._apply(d, c, amt)
+
+    def _apply(self, d, c, amt):
+        if d == c: return
+        key, sign = ((d, c), 1) if d < c else ((c, d), -1)
+        v = self.pairs.get(key, 0) + sign * amt
+        if v: self.pairs[key] = v
+        else: self.pairs.pop(key, None)
+
+    def to_records(self): return list(self.entries)
+    def clear(self): self.entries.clear(); self.pairs.clear(); self.cleared += 1
+    def __len__(self): return len(self.entries)
+    def __bool__(self): return bool(self.entries)
+
+    def balances(self):
+        # [(欠款人, 債主, 金額)]
+        return [(a, b, v) if v > 0 else (b, a, -v) for (a, b), v in self.pairs.items()]
+
+    def simplify(self):
+        # 先算每人淨額，再讓欠最多的付給收最多的 (貪婪法，最多 人數-1 筆)
+        net = {}
+        for (a, b), v in self.pairs.items(): net[a] = net.get(a, 0) - v; net[b] = net.get(b, 0) + v
+        debtors = sorted([[-v, p] for p, v in net.items() if v < 0], reverse=True)
+        creditors = sorted([[v, p] for p, v in net.items() if v > 0], reverse=True)
+        out = []; i = j = 0
+        while i < len(debtors) and j < len(creditors):
+            amt = min(debtors[i][0], creditors[j][0]); out.append((debtors[i][1], creditors[j][1], amt))
+            debtors[i][0] -= amt; creditors[j][0] -= amt
+            if not debtors[i][0]: i += 1
+            if not creditors[j][0]: j += 1
+        return out
+
+    def page(self, page, size):
+        # 新的在前；回傳 (該頁明細, 總頁數)
+        pages = max(1, -(-len(self.entries) // size)); page = min(max(1, page), pages)
+        end = len(self.entries) - (page - 1) * size
+        return self.entries[max(0, end - size):end][::-1], pages
+
+# --- 🎲 莊家場次：每筆輸贏直接累加到玩家淨額，!下莊 不用重播整本紀錄 ---
+class SessionEntry:
+    __slots__ = ('pid', 'delta', 'desc', 'ts')
+    def __init__(self, pid, delta, desc): self.pid, self.delta, self.desc, self.ts = pid, delta, desc, int(time.time())
+
+class SessionBook:
+    __slots__ = ('balances', 'names', 'log', 'events')
+    def __init__(self):
+        self.balances = {}   # pid -> 淨額 (正 = 莊家要給玩家)
+        self.names = {}
+        self.log = deque(maxlen=SESSION_LOG_MAX) if SESSION_LOG_MAX else None
+        self.events = 0
+
+    def to_dict(self):
+        return {'balances': dict(self.balances), 'names': dict(self.names), 'events': self.events,
+                'log': [(e.pid, e.delta, e.desc, e.ts) for e in self.log] if self.log is not None else None}
+
+    @classmethod
+    def from_dict(cls, data):
+        book = cls(); book.balances, book.names, book.events = data['balances'], data['names'], data['events']
+        if book.log is not None:
+            for pid, delta, desc, ts in data['log'] or (): e = SessionEntry(pid, delta, desc); e.ts = ts; book.log.append(e)
+        return book
+
+    def record(self, pid, name, delta, desc):
+        self.balances[pid] = self.balances.get(pid, 0) + delta; self.names[pid] = name; self.events += 1
+        if self.log is not None: self.log.append(SessionEntry(pid, delta, desc))
+
+    def standings(self):
+        # [(pid, 名字, 淨額)]
+        return [(pid, self.names[pid], v) for pid, v in self.balances.items()]
+
+    def __len__(self): return self.events
+
+# 存進 DB 的是純資料 (dict/list/set/deque)，不 pickle 這個模組的類別：讀檔不受 import 順序或改版影響
+# 帳本明細會一直長，不跟房間一起存，房間裡只記筆數；明細另外放只會往後加的 ledger 表
+def pack_room(room):
+    data = dict(room); game = data['game'] = dict(room['game'])
+    data['debt'] = {'n': len(room['debt']), 'cleared': room['debt'].cleared}; game['session'] = game['session'].to_dict()
+    return data
+
+def unpack_room(data):
+    # debt 還是 {'n', 'cleared'}，留給 SQLiteState 從 ledger 表補明細
+    data['game']['session'] = SessionBook.from_dict(data['game']['session'])
+    return data
+
+# --- 💾 狀態儲存：房間資料 + 管理名單，handler 都包在 state.transaction(房間) 裡 ---
+class MemoryState:
+    def __init__(self):
+        self.rooms = {}; self.sets = {}
+
+    @contextmanager
+    def transaction(self, room_id):
+        with room_locks.hold(room_id): yield
+
+    def get_room(self, room_id): return self.rooms.get(room_id)
+    def put_room(self, room_id, room): self.rooms[room_id] = room; return room
+    def room_ids(self): return list(self.rooms)
+    def shared_set(self, name): return self.sets.setdefault(name, set())
+    # webhook 去重：單一 process 時 EventDedup 自己記的就夠了
+    def claim_event(self, event_id, expire_before): return True
+    def release_event(self, event_id): pass
+    def stats(self): return {"backend": "memory", "rooms": len(self.rooms)}
+
+class SQLiteSet:
+    def __init__(self, state, name): self.state, self.name = state, name
+    def _q(self, sql, *args): return self.state._conn().execute(sql, (self.name,) + args)
+    def __contains__(self, member): return self._q("SELECT 1 FROM members WHERE name=? AND member=?", member).fetchone() is not None
+    def __iter__(self): return iter([r[0] for r in self._q("SELECT member FROM members WHERE name=?")])
+    def __len__(self): return self._q("SELECT COUNT(*) FROM members WHERE name=?").fetchone()[0]
+    def add(self, member): self._q("INSERT OR IGNORE INTO members(name, member) VALUES(?, ?)", member)
+    def discard(self, member): self._q("DELETE FROM members WHERE name=? AND member=?", member)
+    def remove(self, member):
+        if member not in self: raise KeyError(member)
+        self.discard(member)
+
+class SQLiteState(MemoryState):
+    # WAL 模式；同一房間跨 process 用 flock 條紋鎖排隊，不同房間互不影響
+    def __init__(self, path, write_behind=0):
+        super().__init__()
+        self.path, self.write_behind = path, write_behind
+        self.local = threading.local(); self.versions = {}; self.dirty = set(); self.dirty_lock = threading.Lock()
+        self.lock_dir = path + '.locks'; os.makedirs(self.lock_dir, exist_ok=True)
+        self.reloads = self.writes = self.flushes = 0
+        conn = self._conn(); conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS rooms (id TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS members (name TEXT NOT NULL, member TEXT NOT NULL, PRIMARY KEY (name, member))")
+        conn.execute("CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY, ts REAL NOT NULL)"); self.claim_seq = itertools.count(1)
+        conn.execute("CREATE TABLE IF NOT EXISTS ledger (room_id TEXT NOT NULL, seq INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (room_id, seq))")
+        self.digests = {}        # room_id -> 上次讀/寫的內容雜湊，沒變就不寫、不升版本
+        self.ledger_saved = {}   # room_id -> (cleared, 筆數)：DB 裡 ledger 表目前的樣子
+        self.skipped = 0
+        started = time.time()
+        for rid, ver, blob in conn.execute("SELECT id, version, data FROM rooms").fetchall(): self._load(conn, rid, ver, blob)
+        self.warm_start_ms = round((time.time() - started) * 1000, 2)
+        if write_behind:
+            threading.Thread(target=self._flusher, daemon=True).start(); atexit.register(self.flush)
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # 重送可能落到別的 worker，所以看過的 event id 也寫一份進 DB；過期的每 500 次順手清
+    def claim_event(self, event_id, expire_before):
+        conn = self._conn()
+        if next(self.claim_seq) % 500 == 0: conn.execute("DELETE FROM events WHERE ts < ?", (expire_before,))
+        return conn.execute("INSERT INTO events(id, ts) VALUES(?, ?) ON CONFLICT(id) DO UPDATE SET ts=excluded.ts WHERE events.ts < ?",
+                            (event_id, time.time(), expire_before)).rowcount == 1
+
+    def release_event(self, event_id): self._conn().execute("DELETE FROM events WHERE id=?", (event_id,))
+
+    @staticmethod
+    def _pack(room):
+        blob = pickle.dumps(pack_room(room), protocol=pickle.HIGHEST_PROTOCOL); return blob, hashlib.sha1(blob).digest()
+
+    def _load(self, conn, room_id, version, blob):
+        room = unpack_room(pickle.loads(blob)); meta = room['debt']; cached = self.rooms.get(room_id)
+        ledger = cached['debt'] if cached and cached['debt'].cleared == meta['cleared'] and len(cached['debt']) <= meta['n'] else Ledger()
+        ledger.cleared = meta['cleared']
+        rows = conn.execute("SELECT data FROM ledger WHERE room_id=? AND seq>=? AND seq<? ORDER BY seq", (room_id, len(ledger), meta['n']))
+        ledger.extend(json.loads(d) for (d,) in rows); room['debt'] = ledger
+        self.ledger_saved[room_id] = (meta['cleared'], meta['n'])
+        self.rooms[room_id] = room; self.versions[room_id] = version
+        # 用重新打包的雜湊比 (set 的順序每個 process 不同)，免得讀進來沒改也被當成有改
+        self.digests[room_id] = self._pack(room)[1]
+
+    def _reload(self, room_id):
+        conn = self._conn(); row = conn.execute("SELECT version, data FROM rooms WHERE id=?", (room_id,)).fetchone()
+        if row and row[0] != self.versions.get(room_id): self._load(conn, room_id, row[0], row[1]); self.reloads += 1
+
+    def _ledger_rows(self, room_id, ledger):
+        # 回傳 (要不要先刪光, 要補的明細)；清空過或 DB 狀態不明才整本重寫
+        saved = self.ledger_saved.get(room_id)
+        if saved is None or saved[0] != ledger.cleared or saved[1] > len(ledger): return True, list(enumerate(ledger.entries))
+        return False, list(enumerate(ledger.entries[saved[1]:], saved[1]))
+
+    def _write(self, room_ids):
+        # 先在各房間鎖裡打包好 (blob、雜湊、要補的明細)，鎖放掉才開 DB 交易：
+        # 不會拿著 SQLite 寫鎖去等房間鎖，房間裡的 handler 也不會反過來等寫鎖
+        plans = []
+        for rid in room_ids:
+            with room_locks.hold(rid):
+                room = self.rooms.get(rid)
+                if room is None: continue
+                blob, digest = self._pack(room)
+                if digest == self.digests.get(rid): self.skipped += 1; continue
+                reset, rows = self._ledger_rows(rid, room['debt'])
+                rows = [(rid, i, json.dumps(e, ensure_ascii=False)) for i, e in rows]
+                plans.append((rid, blob, digest, reset, rows, (room['debt'].cleared, len(room['debt']))))
+        if not plans: return
+        conn = self._conn(); conn.execute("BEGIN")
+        try:
+            for rid, blob, digest, reset, rows, saved in plans:
+                if reset: conn.execute("DELETE FROM ledger WHERE room_id=?", (rid,))
+                conn.executemany("INSERT INTO ledger(room_id, seq, data) VALUES(?, ?, ?)", rows)
+                ver = self.versions.get(rid, 0) + 1
+                conn.execute("INSERT INTO rooms(id, version, data) VALUES(?, ?, ?) ON CONFLICT(id) DO UPDATE SET version=excluded.version, data=excluded.data", (rid, ver, blob))
+                self.versions[rid] = ver; self.digests[rid] = digest; self.ledger_saved[rid] = saved; self.writes += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            for rid, *_ in plans: self.digests.pop(rid, None); self.ledger_saved.pop(rid, None)
+            raise
+
+    @contextmanager
+    def transaction(self, room_id):
+        with room_locks.hold(room_id):
+            with self._process_transaction(room_id): yield
+
+    @contextmanager
+    def _process_transaction(self, room_id):
+        import fcntl   # 只有 POSIX 有，放這裡 memory 模式在 Windows 也能跑
+        held = self.local.__dict__.setdefault('held', set())
+        if room_id in held: yield; return
+        fd = None
+        if not self.write_behind:
+            fd = open(os.path.join(self.lock_dir, f"{hash_stripe(room_id, STATE_LOCK_STRIPES)}.lock"), 'a')
+            fcntl.flock(fd, fcntl.LOCK_EX); self._reload(room_id)
+        held.add(room_id)
+        try: yield
+        finally:
+            held.discard(room_id)
+            try:
+                if self.write_behind:
+                    with self.dirty_lock: self.dirty.add(room_id)
+                else: self._write([room_id])
+            finally:
+                if fd: fcntl.flock(fd, fcntl.LOCK_UN); fd.close()
+
+    def get_room(self, room_id):
+        if room_id not in self.rooms and not self.write_behind: self._reload(room_id)
+        return self.rooms.get(room_id)
+
+    def room_ids(self):
+        ids = [r[0] for r in self._conn().execute("SELECT id FROM rooms")]
+        return ids + [rid for rid in self.rooms if rid not in set(ids)]
+
+    def shared_set(self, name): return SQLiteSet(self, name)
+
+    def flush(self):
+        with self.dirty_lock: ids, self.dirty = self.dirty, set()
+        if not ids: return
+        try: self._write(sorted(ids)); self.flushes += 1
+        except Exception:
+            with self.dirty_lock: self.dirty |= ids
+            raise
+
+    def _flusher(self):
+        while True:
+            time.sleep(self.write_behind)
+            try: self.flush()
+            except Exception as e: print(f"State flush error: {e}")
+
+    def snapshot(self, path):
+        if self.write_behind: self.flush()
+        dst = sqlite3.connect(path)
+        try: self._conn().backup(dst)
+        finally: dst.close()
+
+    def stats(self):
+        return {"backend": "sqlite", "path": self.path, "rooms_cached": len(self.rooms), "write_behind": self.write_behind,
+                "dirty": len(self.dirty), "reloads": self.reloads, "writes": self.writes, "unchanged_skipped": self.skipped, "flushes": self.flushes, "warm_start_ms": self.warm_start_ms}
+
+def hash_stripe(key, stripes):
+    # 不用內建 hash()：每個 process 的亂數種子不同，跨 worker 要一致
+    return int(hashlib.md5(str(key).encode()).hexdigest()[:8], 16) % stripes
+
+state = SQLiteState(STATE_PATH, STATE_WRITE_BEHIND) if STATE_BACKEND == 'sqlite' else MemoryState()
 
 # 全域設定
-ADMINS = {OWNER_ID} 
-AUTHORIZED_GROUPS = set()
-BLACKLIST = set()
+ADMINS = state.shared_set('admins'); ADMINS.add(OWNER_ID)
+AUTHORIZED_GROUPS = state.shared_set('authorized_groups')
+BLACKLIST = state.shared_set('blacklist')
+
+class SQLiteMessageStore:
+    # 多 worker 時收回事件不一定落在收到原文的那個 worker，所以文字也放 DB
+    # 每群上限每次寫入順手修；過期和全域上限每 200 筆清一次
+    def __init__(self, state, per_room, max_total, ttl):
+        self.state, self.per_room, self.max_total, self.ttl = state, per_room, max_total, ttl
+        self.seq = itertools.count(1); conn = state._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS messages (msg_id TEXT PRIMARY KEY, room_id TEXT NOT NULL, ts REAL NOT NULL, text TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS messages_room ON messages(room_id, ts)"); conn.execute("CREATE INDEX IF NOT EXISTS messages_ts ON messages(ts)")
+
+    def put(self, room_id, msg_id, text):
+        conn = self.state._conn(); now = time.time()
+        conn.execute("INSERT OR REPLACE INTO messages(msg_id, room_id, ts, text) VALUES(?, ?, ?, ?)", (msg_id, room_id, now, text))
+        conn.execute("DELETE FROM messages WHERE room_id=? AND ts < (SELECT ts FROM messages WHERE room_id=? ORDER BY ts DESC LIMIT 1 OFFSET ?)", (room_id, room_id, self.per_room - 1))
+        if next(self.seq) % 200 == 0:
+            conn.execute("DELETE FROM messages WHERE ts < ?", (now - self.ttl,))
+            conn.execute("DELETE FROM messages WHERE ts < (SELECT ts FROM messages ORDER BY ts DESC LIMIT 1 OFFSET ?)", (self.max_total - 1,))
+
+    def get(self, msg_id):
+        row = self.state._conn().execute("SELECT text FROM messages WHERE msg_id=? AND ts>=?", (msg_id, time.time() - self.ttl)).fetchone()
+        return row[0] if row else None
+
+    def __contains__(self, msg_id): return self.get(msg_id) is not None
+    def __len__(self): return self.state._conn().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    @property
+    def bytes(self): return self.state._conn().execute("SELECT COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) FROM messages").fetchone()[0]
+
+    def stats(self):
+        n, rooms, size = self.state._conn().execute("SELECT COUNT(*), COUNT(DISTINCT room_id), COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) FROM messages").fetchone()
+        return {"backend": "sqlite", "messages": n, "rooms": rooms, "text_bytes": size, "per_room_cap": self.per_room, "global_cap": self.max_total, "ttl": self.ttl}
+
+if STATE_BACKEND == 'sqlite': message_store = SQLiteMessageStore(state, MSG_STORE_PER_ROOM, MSG_STORE_MAX, MSG_STORE_TTL)
+else: message_store = MessageStore(MSG_STORE_PER_ROOM, MSG_STORE_MAX, MSG_STORE_TTL)
+startup.mark('state')
+
+# --- ⏰ 單一計時器執行緒 (heap 排序到期時間，取代每局開一條 sleep 的 thread) ---
+class TimerScheduler:
+    def __init__(self, workers):
+        self.cond = threading.Condition(); self.heap = []; self.seq = itertools.count()
+        self.keys = {}      # key -> 目前有效的 timer id (同 key 重排會蓋掉舊的)
+        self.live = set()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="timer")
+        self.fired = 0; self.cancelled = 0; self.late_total = 0.0; self.late_max = 0.0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, delay, fn, *args, key=None):
+        with self.cond:
+            tid = next(self.seq)
+            if key is not None: self._cancel(self.keys.get(key)); self.keys[key] = tid
+            heapq.heappush(self.heap, (time.time() + delay, tid, key, fn, args)); self.live.add(tid)
+            self.cond.notify()
+            return tid
+
+    def _cancel(self, tid):
+        if tid in self.live: self.live.discard(tid); self.cancelled += 1
+
+    def cancel(self, key):
+        with self.cond: self._cancel(self.keys.pop(key, None))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                # 取消的只從 live 移除，輪到時直接丟掉 (lazy delete)
+                while self.heap and self.heap[0][1] not in self.live: heapq.heappop(self.heap)
+                if not self.heap: self.cond.wait(); continue
+                wait = self.heap[0][0] - time.time()
+                if wait > 0: self.cond.wait(wait); continue
+                due, tid, key, fn, args = heapq.heappop(self.heap); self.live.discard(tid)
+                if key is not None and self.keys.get(key) == tid: del self.keys[key]
+                late = time.time() - due; self.fired += 1; self.late_total += late; self.late_max = max(self.late_max, late)
+            self.executor.submit(self._call, fn, args)
+
+    @staticmethod
+    def _call(fn, args):
+        try: fn(*args)
+        except Exception as e: print(f"Timer error: {e}"); traceback.print_exc()
+
+    def stats(self):
+        with self.cond:
+            return {"pending": len(self.live), "fired": self.fired, "cancelled": self.cancelled,
+                    "late_avg_ms": round(self.late_total / self.fired * 1000, 2) if self.fired else 0, "late_max_ms": round(self.late_max * 1000, 2)}
+
+scheduler = TimerScheduler(TIMER_WORKERS)
 
 def get_room_data(source_id):
-    if source_id not in rooms_data:
-        new_deck = [1, 2, 3, 4, 5, 6, 7, 8, 9, 0.5] * 4
-        random.shuffle(new_deck)
-        rooms_data[source_id] = {
-            'debt': [], 'deck': new_deck, 'unsent_buffer': [],
+    room = state.get_room(source_id)
+    if room is None:
+        room = state.put_room(source_id, {
+            'debt': Ledger(), 'deck': new_deck('tui'), 'unsent_buffer': deque(maxlen=UNSENT_BUFFER_MAX),
             'outsider_warn': {}, 
             'game': {
                 'banker_id': None, 'banker_name': None, 'game_type': None,
                 'banker_card_val': None, 'banker_desc': "", 'bets': {},
-                'player_results': {}, 'session_log': [], 'played_users': [],
+                'player_results': {}, 'session': SessionBook(), 'played_users': [],
                 'betting_locked': False, 'session_locked': False, 'allowed_players': set(),
                 'round_id': 0
             }
-        }
-    return rooms_data[source_id]
+        })
+    return room
+
+# --- 🖼 圖片暫存：背景下載 + 依內容去重 + 記憶體到期索引 (不再整個資料夾掃) ---
+class ImageStore:
+    def __init__(self, ttl, max_bytes, workers, queue_max):
+        self.ttl, self.max_bytes = ttl, max_bytes
+        self.lock = threading.Lock()
+        self.index = OrderedDict()   # msg_id -> (檔名, 到期時間)；TTL 固定，所以插入順序就是到期順序
+        self.refs = {}               # 檔名 -> 幾則訊息共用 (轉傳同一張圖只存一份)
+        self.pending = {}            # msg_id -> Future (還在下載)
+        self.slots = threading.BoundedSemaphore(queue_max)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        self.stats_ = {'saved': 0, 'dedup': 0, 'too_large': 0, 'dropped': 0, 'errors': 0, 'expired': 0}
+
+    def submit(self, msg_id):
+        if not self.slots.acquire(blocking=False):
+            with self.lock: self.stats_['dropped'] += 1
+            return
+        with self.lock: self.pending[msg_id] = self.executor.submit(self._capture, msg_id)
+
+    def _capture(self, msg_id):
+        tmp = os.path.join(static_tmp_path, f".{msg_id}.part"); digest = hashlib.sha1(); size = 0
+        try:
+            content = line_bot_api.get_message_content(msg_id)
+            with open(tmp, 'wb') as fd:
+                for chunk in content.iter_content(chunk_size=IMAGE_CHUNK):
+                    size += len(chunk)
+                    if size > self.max_bytes: break
+                    digest.update(chunk); fd.write(chunk)
+            if size > self.max_bytes:
+                os.remove(tmp)
+                with self.lock: self.stats_['too_large'] += 1
+                return
+            self._attach(msg_id, f"{digest.hexdigest()}.jpg", tmp)
+        except Exception:
+            with self.lock: self.stats_['errors'] += 1
+            try: os.remove(tmp)
+            except OSError: pass
+        finally:
+            with self.lock: self.pending.pop(msg_id, None)
+            self.slots.release()
+
+    def _attach(self, msg_id, name, tmp):
+        with self.lock:
+            if name in self.refs: os.remove(tmp); self.refs[name] += 1; self.stats_['dedup'] += 1
+            else: os.replace(tmp, os.path.join(static_tmp_path, name)); self.refs[name] = 1; self.stats_['saved'] += 1
+            self.index[msg_id] = (name, time.time() + self.ttl)
+
+    def _find(self, msg_id):
+        with self.lock:
+            item = self.index.get(msg_id)
+            return item[0] if item and item[1] > time.time() else None
+
+    def lookup(self, msg_id, wait=5):
+        # 收回時圖片可能還在下載，最多等幾秒
+        with self.lock: fut = self.pending.get(msg_id)
+        if fut is not None:
+            try: fut.result(timeout=wait)
+            except Exception: swallowed('image_lookup_wait')
+        return self._find(msg_id)
+
+    def _release(self, name):
+        self.refs[name] -= 1
+        if self.refs[name] > 0: return
+        del self.refs[name]; path = os.path.join(static_tmp_path, name)
+        try: os.remove(path)
+        except OSError: pass
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            while self.index:
+                msg_id, (name, deadline) = next(iter(self.index.items()))
+                if deadline > now: break
+                del self.index[msg_id]; self._release(name); self.stats_['expired'] += 1
+
+    @staticmethod
+    def disk_usage():
+        # 直接量 static/tmp：含上次留下的檔案和下載中的 .part
+        files = size = 0
+        with os.scandir(static_tmp_path) as it:
+            for entry in it:
+                try:
+                    if entry.is_file(): files += 1; size += entry.stat().st_size
+                except OSError: pass
+        return files, size
+
+    def adopt_leftovers(self):
+        # 開機時把上次留下的檔案收進索引，到期 = mtime + TTL；已經過期的下一輪 expire 就刪
+        found = []
+        with os.scandir(static_tmp_path) as it:
+            for entry in it:
+                try:
+                    if entry.is_file(): found.append((entry.name, entry.stat().st_mtime + self.ttl))
+                except OSError: pass
+        with self.lock: partial = {f".{m}.part" for m in self.pending}
+        return self._adopt([(name, deadline) for name, deadline in found if name not in partial])
+
+    def _adopt(self, found):
+        with self.lock:
+            fresh = [(f"file:{name}", (name, deadline)) for name, deadline in found if name not in self.refs]
+            for _, (name, _) in fresh: self.refs[name] = 1
+            # expire 靠插入順序 = 到期順序，所以合併後重排一次
+            self.index = OrderedDict(sorted(list(self.index.items()) + fresh, key=lambda kv: kv[1][1]))
+        return len(fresh)
+
+    def _counts(self):
+        with self.lock: return len(self.index), len(self.refs)
+
+    def stats(self):
+        (images, files), (disk_files, disk_bytes) = self._counts(), self.disk_usage()
+        with self.lock: return dict(self.stats_, images=images, files=files, downloading=len(self.pending), disk_files=disk_files, disk_bytes=disk_bytes)
+
+class SQLiteImageStore(ImageStore):
+    # 索引放 DB：收回事件落到哪個 worker 都找得到圖；檔案本來就在同一台機器的 static/tmp
+    def __init__(self, state, *args):
+        super().__init__(*args); self.state = state; conn = state._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS images (msg_id TEXT PRIMARY KEY, name TEXT NOT NULL, deadline REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS images_name ON images(name)"); conn.execute("CREATE INDEX IF NOT EXISTS images_deadline ON images(deadline)")
+
+    @contextmanager
+    def _tx(self):
+        # BEGIN IMMEDIATE：搬檔/刪檔跟索引在同一把寫鎖裡，別的 worker 不會刪到剛被共用的檔
+        conn = self.state._conn(); conn.execute("BEGIN IMMEDIATE")
+        try: yield conn
+        except BaseException: conn.execute("ROLLBACK"); raise
+        else: conn.execute("COMMIT")
+
+    def _attach(self, msg_id, name, tmp):
+        with self._tx() as conn:
+            shared = conn.execute("SELECT 1 FROM images WHERE name=? LIMIT 1", (name,)).fetchone() is not None
+            if shared: os.remove(tmp)
+            else: os.replace(tmp, os.path.join(static_tmp_path, name))
+            conn.execute("INSERT OR REPLACE INTO images(msg_id, name, deadline) VALUES(?, ?, ?)", (msg_id, name, time.time() + self.ttl))
+        with self.lock: self.stats_['dedup' if shared else 'saved'] += 1
+
+    def _find(self, msg_id):
+        row = self.state._conn().execute("SELECT name FROM images WHERE msg_id=? AND deadline>?", (msg_id, time.time())).fetchone()
+        return row[0] if row else None
+
+    def expire(self):
+        now = time.time()
+        with self._tx() as conn:
+            due = conn.execute("SELECT DISTINCT name FROM images WHERE deadline<=?", (now,)).fetchall()
+            expired = conn.execute("DELETE FROM images WHERE deadline<=?", (now,)).rowcount
+            for (name,) in due:
+                if conn.execute("SELECT 1 FROM images WHERE name=? LIMIT 1", (name,)).fetchone() is None:
+                    try: os.remove(os.path.join(static_tmp_path, name))
+                    except OSError: pass
+        with self.lock: self.stats_['expired'] += expired
+
+    def _adopt(self, found):
+        with self._tx() as conn:
+            fresh = [(f"file:{name}", name, deadline) for name, deadline in found
+                     if conn.execute("SELECT 1 FROM images WHERE name=? LIMIT 1", (name,)).fetchone() is None]
+            conn.executemany("INSERT OR IGNORE INTO images(msg_id, name, deadline) VALUES(?, ?, ?)", fresh)
+        return len(fresh)
+
+    def _counts(self): return self.state._conn().execute("SELECT COUNT(*), COUNT(DISTINCT name) FROM images").fetchone()
+
+if STATE_BACKEND == 'sqlite': image_store = SQLiteImageStore(state, IMAGE_TTL, IMAGE_MAX_BYTES, IMAGE_WORKERS, IMAGE_QUEUE_MAX)
+else: image_store = ImageStore(IMAGE_TTL, IMAGE_MAX_BYTES, IMAGE_WORKERS, IMAGE_QUEUE_MAX)
 
 def cleanup_images():
+    # 開機時把上次留下的檔案 (含沒下載完的 .part) 收進到期索引，之後每分鐘處理到期的
+    try: image_store.adopt_leftovers()
+    except Exception: swallowed('image_startup_sweep')
     while True:
-        try:
-            now = time.time()
-            for f in os.listdir(static_tmp_path):
-                f_path = os.path.join(static_tmp_path, f)
-                if os.stat(f_path).st_mtime < now - 3600: os.remove(f_path)
-        except: pass
-        time.sleep(3600)
+        try: image_store.expire()
+        except Exception: swallowed('image_expire')
+        time.sleep(60)
 
-threading.Thread(target=cleanup_images, daemon=True).start()
 
 @app.route("/")
 def home(): return "Robot is Alive!"
 
+@app.route("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}": abort(403)
+    img = image_store.stats(); timers = scheduler.stats()
+    gauges = [
+        ('linebot_rooms', 'Known rooms', len(state.room_ids())),
+        ('linebot_message_store_messages', 'Texts kept for unsend recovery', len(message_store)),
+        ('linebot_message_store_bytes', 'Approximate bytes of stored texts', message_store.bytes),
+        ('linebot_unsent_buffered', 'Unsent items waiting for !抓', sum(len(r['unsent_buffer']) for r in list(state.rooms.values()))),
+        ('linebot_tmp_images', 'Images indexed in static/tmp', img['images']),
+        ('linebot_tmp_downloads', 'Image downloads in flight', img['downloading']),
+        ('linebot_tmp_disk_files', 'Files in static/tmp, including leftovers and partial downloads', img['disk_files']),
+        ('linebot_tmp_disk_bytes', 'Bytes on disk in static/tmp, including leftovers and partial downloads', img['disk_bytes']),
+        ('linebot_threads', 'Live Python threads', threading.active_count()),
+        ('linebot_timers_pending', 'Pending scheduler timers', timers['pending']),
+        ('linebot_dedup_tracked_events', 'Webhook event ids remembered for deduplication', event_dedup.stats()['tracked']),
+        ('linebot_translator_circuit_open', 'Translator circuit breaker open', int(not translate_breaker.allow())),
+    ]
+    boot = startup.stats()
+    gauges += [('linebot_startup_seconds', 'Time spent in each startup phase', round(ms / 1000, 4), {'phase': k}) for k, ms in boot['phases_ms'].items()]
+    gauges += [('linebot_lazy_load_seconds', 'Time the first use of a deferred module or client took', round(ms / 1000, 4), {'component': k}) for k, ms in boot['lazy_loaded_ms'].items()]
+    if event_pool: gauges.append(('linebot_event_queue_depth', 'Webhook events waiting for a worker', sum(event_pool.snapshot()['depth'])))
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 # --- 🔌 PC 控制台接口 ---
 @app.route("/api/control", methods=['POST'])
 def api_control():
@@ -90,7 +1202,44 @@ def api_control():
     if pwd != API_PASSWORD: return jsonify({"status": "error", "message": "密碼錯誤"}), 403
 
     if cmd == "get_status":
-        return jsonify({"status": "ok", "blacklist": list(BLACKLIST), "active_groups": list(rooms_data.keys())})
+        unsent = sum(len(r['unsent_buffer']) for r in list(state.rooms.values()))
+        return jsonify({"status": "ok", "blacklist": list(BLACKLIST), "active_groups": state.room_ids(), "state": state.stats(),
+                        "memory": {"message_store": message_store.stats(), "unsent_buffered": unsent, "unsent_cap": UNSENT_BUFFER_MAX, "images": image_store.stats()}})
+    elif cmd == "queue_stats":
+        return jsonify({"status": "ok", "async": event_pool is not None, "queue": event_pool.snapshot() if event_pool else None, "timers": scheduler.stats(), "dedup": event_dedup.stats()})
+    elif cmd == "flood_stats":
+        return jsonify({"status": "ok", "flood": flood.stats()})
+    elif cmd == "flood_set":
+        # payload: {"scope": "scrape", "rate": 0.1, "burst": 3} (rate 0 = 不限)；也可以改 notice_seconds / ban_strikes / ban_window
+        if payload.get('scope'): flood.set_limit(payload['scope'], float(payload.get('rate', 0)), payload.get('burst') and float(payload['burst']))
+        for k, attr in (('notice_seconds', 'notice_every'), ('ban_strikes', 'ban_strikes'), ('ban_window', 'ban_window')):
+            if k in payload: setattr(flood, attr, int(payload[k]))
+        return jsonify({"status": "ok", "flood": flood.stats()})
+    elif cmd == "flood_reset":
+        flood.reset(payload.get('user_id'))
+        return jsonify({"status": "ok", "message": f"已重設 {payload.get('user_id') or '全部'} 的洗版額度"})
+    elif cmd == "startup_stats":
+        return jsonify({"status": "ok", "startup": startup.stats()})
+    elif cmd == "api_stats":
+        return jsonify({"status": "ok", "line_api": line_api_stats.snapshot()})
+    elif cmd == "command_stats":
+        return jsonify({"status": "ok", "commands": commands.stats()})
+    elif cmd == "simulate":
+        try: job = simulator.start(payload.get('game', 'niu'), payload.get('rounds', 100000), payload.get('players', 4), payload.get('bet', 100), payload.get('seed'))
+        except ImportError: return jsonify({"status": "error", "message": "需要安裝 numpy"})
+        except ValueError as e: return jsonify({"status": "error", "message": str(e)})
+        return jsonify({"status": "ok", "message": f"模擬 {job.args[1]} 局已排入背景", "job_id": job.id})
+    elif cmd == "simulate_status":
+        job_id = payload.get('job_id')
+        if not job_id: return jsonify({"status": "ok", "jobs": [j.snapshot() for j in list(simulator.jobs.values())]})
+        job = simulator.get(job_id)
+        if not job: return jsonify({"status": "error", "message": "找不到工作"})
+        return jsonify({"status": "ok", "job": job.snapshot()})
+    elif cmd == "lock_stats":
+        return jsonify({"status": "ok", "locks": room_locks.stats(int(payload.get('top', 10)))})
+    elif cmd == "cache_stats":
+        return jsonify({"status": "ok", "names": name_cache.stats(), "translations": translation_cache.stats(), "translator": translate_breaker.stats(),
+                        "quotes": quote_cache.stats(), "geocode": geo_cache.stats()})
     elif cmd == "blacklist_add":
         uid = payload.get('user_id'); 
         if uid: BLACKLIST.add(uid)
@@ -100,28 +1249,308 @@ def api_control():
         if uid and uid in BLACKLIST: BLACKLIST.remove(uid)
         return jsonify({"status": "ok", "message": f"已解鎖 {uid}"})
     elif cmd == "broadcast":
-        msg = payload.get('message'); count = 0
-        if msg:
-            for gid in rooms_data:
-                try: line_bot_api.push_message(gid, TextSendMessage(text=f"📢 [公告] {msg}")); count += 1
-                except: pass
-        return jsonify({"status": "ok", "message": f"已發送給 {count} 個群組"})
+        msg = payload.get('message')
+        if not msg: return jsonify({"status": "error", "message": "沒有內容"})
+        job = broadcaster.start(state.room_ids(), msg)
+        return jsonify({"status": "ok", "message": f"開始發送給 {len(job.targets)} 個群組", "job_id": job.id})
+    elif cmd == "broadcast_status":
+        job_id = payload.get('job_id')
+        if not job_id: return jsonify({"status": "ok", "jobs": [j.snapshot() for j in list(broadcaster.jobs.values())]})
+        job = broadcaster.get(job_id)
+        if not job: return jsonify({"status": "error", "message": "找不到工作"})
+        return jsonify({"status": "ok", "job": job.snapshot()})
     elif cmd == "reset_game":
         gid = payload.get('group_id')
-        if gid and gid in rooms_data:
-            new_deck = [1, 2, 3, 4, 5, 6, 7, 8, 9, 0.5] * 4; random.shuffle(new_deck)
-            rooms_data[gid]['deck'] = new_deck
-            rooms_data[gid]['game'] = {'banker_id': None, 'banker_name': None, 'game_type': None, 'banker_card_val': None, 'banker_desc': "", 'bets': {}, 'player_results': {}, 'session_log': [], 'played_users': [], 'betting_locked': False, 'session_locked': False, 'allowed_players': set(), 'round_id': rooms_data[gid]['game'].get('round_id', 0) + 1}
-            return jsonify({"status": "ok", "message": "重置成功"})
+        if gid:
+            with state.transaction(gid):
+                room = state.get_room(gid)
+                if room is not None:
+                    room['deck'] = new_deck('tui'); scheduler.cancel(('round', gid))
+                    room['game'] = {'banker_id': None, 'banker_name': None, 'game_type': None, 'banker_card_val': None, 'banker_desc': "", 'bets': {}, 'player_results': {}, 'session': SessionBook(), 'played_users': [], 'betting_locked': False, 'session_locked': False, 'allowed_players': set(), 'round_id': room['game'].get('round_id', 0) + 1}
+                    return jsonify({"status": "ok", "message": "重置成功"})
+    elif cmd == "snapshot":
+        if not isinstance(state, SQLiteState): return jsonify({"status": "error", "message": "memory 模式沒有資料庫可備份 (STATE_BACKEND=sqlite 才支援)"})
+        path = payload.get('path') or f"{STATE_PATH}.{datetime.now().strftime('%Y%m%d%H%M%S')}.bak"
+        try: state.snapshot(path); return jsonify({"status": "ok", "message": f"已備份到 {path}"})
+        except Exception as e: return jsonify({"status": "error", "message": str(e)})
     return jsonify({"status": "error", "message": "未知指令"})
 
+# --- 🪣 Token bucket 限速 ---
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate; self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity; self.updated = time.time(); self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+
+    def try_acquire(self, n=1):
+        with self.lock:
+            self._refill(time.time())
+            if self.tokens >= n: self.tokens -= n; return True
+            return False
+
+    def acquire(self, n=1):
+        while True:
+            with self.lock:
+                self._refill(time.time())
+                if self.tokens >= n: self.tokens -= n; return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+# --- 🚧 洗版防護：每人 / 每房 / 每人每類指令各一個 TokenBucket，在翻譯、抓資料、查暱稱之前先擋 ---
+# 桶子只存在這個 process (多 worker 時各算各的)；自動封鎖寫進共用的 BLACKLIST
+def parse_flood_limits(spec):
+    return {scope.strip(): tuple(float(x) for x in rule.split('/')) for scope, rule in (p.split('=') for p in spec.split(',') if p.strip())}
+
+class FloodControl:
+    def __init__(self, limits, notice_every, ban_strikes, ban_window, track_max):
+        self.lock = threading.Lock(); self.limits = dict(limits)
+        self.notice_every, self.ban_strikes, self.ban_window, self.track_max = notice_every, ban_strikes, ban_window, track_max
+        self.buckets = OrderedDict()   # (範圍, key) -> TokenBucket；LRU，被擠掉的桶下次重建等於額度回滿
+        self.offenders = OrderedDict() # user_id -> [被擋時間 deque, 上次提醒時間]
+        self.room_noticed = OrderedDict() # room_id -> 上次在這房提醒的時間 (每房每段時間最多一則)
+        self.allowed = 0; self.dropped = {}; self.notices = 0; self.bans = 0
+
+    def _bucket(self, scope, key):
+        rate, burst = self.limits[scope]
+        with self.lock:
+            b = self.buckets.pop((scope, key), None) or TokenBucket(rate, burst); self.buckets[(scope, key)] = b
+            if len(self.buckets) > self.track_max: self.buckets.popitem(last=False)
+        return b
+
+    # 回傳 'ok' / 'drop' / 'notice' (丟掉但回一次提醒) / 'ban' (剛被自動封鎖)
+    def check(self, user_id, room_id, kind):
+        if user_id == OWNER_ID or user_id in ADMINS: return 'ok'
+        for scope, key in (('user', user_id), ('room', room_id), (kind, user_id)):
+            if scope in self.limits and not self._bucket(scope, key).try_acquire(): return self._strike(user_id, room_id, scope)
+        with self.lock: self.allowed += 1
+        return 'ok'
+
+    def _room_notice_due(self, room_id, now):
+        last = self.room_noticed.pop(room_id, 0); due = bool(self.notice_every) and now - last >= self.notice_every
+        self.room_noticed[room_id] = now if due else last
+        if len(self.room_noticed) > self.track_max: self.room_noticed.popitem(last=False)
+        return due
+
+    def _strike(self, user_id, room_id, scope):
+        now = time.time(); metrics.inc('linebot_flood_dropped_total', scope=scope)
+        with self.lock:
+            self.dropped[scope] = self.dropped.get(scope, 0) + 1
+            # 整房的額度用完不算誰的錯：不記點、不封鎖，只在這房提醒一次
+            if scope == 'room':
+                if not self._room_notice_due(room_id, now): return 'drop'
+                self.notices += 1; return 'notice'
+            rec = self.offenders.pop(user_id, None) or [deque(), 0]; self.offenders[user_id] = rec
+            if len(self.offenders) > self.track_max: self.offenders.popitem(last=False)
+            hits = rec[0]; hits.append(now)
+            while hits[0] < now - self.ban_window: hits.popleft()
+            if self.ban_strikes and len(hits) >= self.ban_strikes: self.bans += 1; verdict = 'ban'
+            elif self.notice_every and now - rec[1] >= self.notice_every and self._room_notice_due(room_id, now): rec[1] = now; self.notices += 1; verdict = 'notice'
+            else: verdict = 'drop'
+        if verdict == 'ban': BLACKLIST.add(user_id); metrics.inc('linebot_flood_bans_total'); print(f"🚧 洗版自動封鎖 {user_id}")
+        return verdict
+
+    def set_limit(self, scope, rate, burst=None):
+        with self.lock:
+            if rate > 0: self.limits[scope] = (rate, burst or max(1, rate))
+            else: self.limits.pop(scope, None)
+            self.buckets = OrderedDict((k, b) for k, b in self.buckets.items() if k[0] != scope)
+
+    def reset(self, user_id=None):
+        with self.lock:
+            if user_id is None: self.buckets.clear(); self.offenders.clear(); self.room_noticed.clear(); return
+            self.offenders.pop(user_id, None)
+            for k in [k for k in self.buckets if k[1] == user_id]: del self.buckets[k]
+
+    def stats(self, top=10):
+        now = time.time()
+        with self.lock:
+            worst = sorted(((sum(t >= now - self.ban_window for t in hits), uid) for uid, (hits, _) in self.offenders.items()), reverse=True)[:top]
+            return {"limits": {k: {"rate": r, "burst": b} for k, (r, b) in self.limits.items()}, "notice_seconds": self.notice_every,
+                    "ban_strikes": self.ban_strikes, "ban_window": self.ban_window, "allowed": self.allowed, "dropped": dict(self.dropped),
+                    "notices": self.notices, "bans": self.bans, "buckets": len(self.buckets), "top_offenders": [{"user_id": u, "strikes": n} for n, u in worst if n]}
+
+flood = FloodControl(parse_flood_limits(FLOOD_LIMITS), FLOOD_NOTICE_SECONDS, FLOOD_BAN_STRIKES, FLOOD_BAN_WINDOW, FLOOD_TRACK_MAX)
+FLOOD_REPLIES = {'notice': "⏳ 太快了，請稍後再試", 'ban': "🚫 洗版次數過多，已自動封鎖"}
+
+def flood_gate(user_id, source_id, kind, reply_messages):
+    verdict = flood.check(user_id, source_id, kind)
+    if verdict in FLOOD_REPLIES: reply_messages.append(TextSendMessage(text=FLOOD_REPLIES[verdict]))
+    return verdict == 'ok'
+
+# 下了注還沒開牌的人，回合計時到了會被判輸；他的遊戲指令不能被洗版防護默默丟掉
+def awaiting_play(room, user_id):
+    game = room['game']; return user_id in game['bets'] and user_id not in game['played_users']
+
+# --- 📢 公告廣播：背景工作 + 限速 + 429/5xx 退避重試，控制台用 job_id 查進度 ---
+class BroadcastJob:
+    def __init__(self, targets, message):
+        self.id = uuid.uuid4().hex[:8]; self.targets = targets; self.message = message
+        self.lock = threading.Lock(); self.sent = 0; self.retries = 0; self.failed = {}
+        self.status = 'running'; self.started = time.time(); self.finished = None
+
+    def snapshot(self):
+        with self.lock:
+            return {"job_id": self.id, "status": self.status, "total": len(self.targets), "sent": self.sent, "retries": self.retries,
+                    "failed": len(self.failed), "failures": dict(list(self.failed.items())[:100]),
+                    "elapsed": round((self.finished or time.time()) - self.started, 2)}
+
+class Broadcaster:
+    def __init__(self, workers, rate, retries, keep=50):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="broadcast")
+        self.bucket = TokenBucket(rate); self.retries = retries
+        self.jobs = OrderedDict(); self.keep = keep; self.lock = threading.Lock()
+
+    def start(self, targets, message):
+        job = BroadcastJob(targets, message)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep: self.jobs.popitem(last=False)
+        threading.Thread(target=self._run, args=(job,), daemon=True).start()
+        return job
+
+    def get(self, job_id):
+        with self.lock: return self.jobs.get(job_id)
+
+    def _run(self, job):
+        list(self.executor.map(lambda gid: self._send(job, gid), job.targets))
+        with job.lock: job.status = 'done'; job.finished = time.time()
+
+    def _send(self, job, gid):
+        # 重試交給 PooledHttpClient；每個群一把固定的 retry key，重試或 409 都不會重複發
+        self.bucket.acquire(); err = None
+        with line_call_options(retry_key=str(uuid.uuid5(uuid.NAMESPACE_URL, f"broadcast/{job.id}/{gid}")), retries=self.retries) as call:
+            try: line_bot_api.push_message(gid, TextSendMessage(text=f"📢 [公告] {job.message}"))
+            except LineBotApiError as e: err = f"{e.status_code} {e.error.message}"
+            except Exception as e: err = str(e)
+        with job.lock:
+            job.retries += call['retried']
+            if err is None: job.sent += 1
+            else: job.failed[gid] = err
+
+broadcaster = Broadcaster(BROADCAST_WORKERS, BROADCAST_RATE, BROADCAST_RETRIES)
+
+# --- 📥 Webhook 背景工作池 (同一群固定同一條 worker，保證順序) ---
+def dispatch_event(event):
+    func = None
+    if isinstance(event, MessageEvent): func = handler._handlers.get(f"{type(event).__name__}_{type(event.message).__name__}")
+    if func is None: func = handler._handlers.get(type(event).__name__)
+    if func is None: return
+    started = time.time()
+    try:
+        with state.transaction(event_source_id(event)): func(event)
+    except Exception: metrics.inc('linebot_handler_errors_total', event=event.type); raise
+    finally: metrics.observe('linebot_event_seconds', time.time() - started, event=event.type)
+
+class EventPool:
+    def __init__(self, workers, maxsize):
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.stats = {'enqueued': 0, 'processed': 0, 'rejected': 0, 'errors': 0, 'max_wait_ms': 0.0, 'max_run_ms': 0.0}
+        self.threads = [threading.Thread(target=self._run, args=(q,), daemon=True) for q in self.queues]
+        for t in self.threads: t.start()
+
+    def submit(self, event):
+        q = self.queues[hash(event_source_id(event)) % len(self.queues)]
+        try: q.put((time.time(), event), timeout=EVENT_QUEUE_TIMEOUT)
+        except queue.Full:
+            with self.lock: self.stats['rejected'] += 1
+            metrics.inc('linebot_events_rejected_total'); return False
+        with self.lock: self.stats['enqueued'] += 1
+        return True
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None: q.task_done(); return
+            queued_at, event = item; started = time.time()
+            try: dispatch_event(event)
+            except Exception as e:
+                print(f"Error: {e}"); traceback.print_exc()
+                with self.lock: self.stats['errors'] += 1
+            finally:
+                q.task_done(); done = time.time()
+                with self.lock:
+                    self.stats['processed'] += 1
+                    self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], (started - queued_at) * 1000)
+                    self.stats['max_run_ms'] = max(self.stats['max_run_ms'], (done - started) * 1000)
+
+    def snapshot(self):
+        with self.lock: data = dict(self.stats)
+        data['depth'] = [q.qsize() for q in self.queues]; data['capacity'] = EVENT_QUEUE_MAX * len(self.queues)
+        return data
+
+    def drain(self, timeout=EVENT_DRAIN_TIMEOUT):
+        for q in self.queues:
+            try: q.put(None, timeout=timeout)
+            except queue.Full: pass
+        deadline = time.time() + timeout
+        for t in self.threads: t.join(max(0, deadline - time.time()))
+
+event_pool = EventPool(EVENT_WORKERS, EVENT_QUEUE_MAX) if ASYNC_WEBHOOK else None
+if event_pool: atexit.register(event_pool.drain)
+
+# --- 🔁 Webhook 去重：LINE 重送同一個 webhookEventId 只處理一次 (不然會重複發牌、重複記帳) ---
+class EventDedup:
+    def __init__(self, ttl, maxsize, redelivery):
+        self.ttl, self.maxsize, self.redelivery = ttl, maxsize, redelivery
+        self.lock = threading.Lock(); self.seen = OrderedDict()   # event id -> 第一次看到的時間；插入順序就是到期順序
+        self.stats_ = {'accepted': 0, 'duplicates': 0, 'redeliveries': 0, 'redelivery_dropped': 0, 'no_id': 0, 'released': 0}
+
+    def _count(self, key):
+        with self.lock: self.stats_[key] += 1
+
+    # True = 第一次看到，要處理
+    def claim(self, event):
+        eid = getattr(event, 'webhook_event_id', None); ctx = getattr(event, 'delivery_context', None)
+        if ctx is not None and ctx.is_redelivery:
+            self._count('redeliveries'); metrics.inc('linebot_webhook_redeliveries_total')
+            if self.redelivery == 'drop':
+                self._count('redelivery_dropped'); metrics.inc('linebot_webhook_dedup_total', result='redelivery_dropped'); return False
+        if not eid: self._count('no_id'); return True
+        now = time.time()
+        with self.lock:
+            while self.seen and next(iter(self.seen.values())) < now - self.ttl: self.seen.popitem(last=False)
+            dup = eid in self.seen
+            if not dup:
+                self.seen[eid] = now
+                if len(self.seen) > self.maxsize: self.seen.popitem(last=False)
+        if not dup and not state.claim_event(eid, now - self.ttl): dup = True
+        self._count('duplicates' if dup else 'accepted')
+        if dup: metrics.inc('linebot_webhook_dedup_total', result='duplicate')
+        return not dup
+
+    # 排不進佇列回 503 的事件要放掉，LINE 重送時才會再處理
+    def release(self, event):
+        eid = getattr(event, 'webhook_event_id', None)
+        if not eid: return
+        with self.lock: self.seen.pop(eid, None); self.stats_['released'] += 1
+        state.release_event(eid)
+
+    def stats(self):
+        with self.lock: return dict(self.stats_, tracked=len(self.seen), ttl=self.ttl, max=self.maxsize, redelivery=self.redelivery)
+
+event_dedup = EventDedup(EVENT_DEDUP_TTL, EVENT_DEDUP_MAX, REDELIVERY_MODE)
+startup.mark('workers')
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    try: handler.handle(body, signature)
+    try:
+        events = handler.parser.parse(body, signature)
+        events = [ev for ev in events if event_dedup.claim(ev)]
+        if event_pool is None:
+            for ev in events: dispatch_event(ev)
+            return 'OK'
     except InvalidSignatureError: abort(400)
     except Exception as e: print(f"Error: {e}"); return 'OK'
+    # 佇列滿了回 503，讓 LINE 之後重送；已經排進去的那幾個重送時會被去重擋掉
+    busy = False
+    for ev in events:
+        if not event_pool.submit(ev): event_dedup.release(ev); busy = True
+    if busy: return 'Busy', 503
     return 'OK'
 
 # --- 🎨 Flex Message ---
@@ -143,40 +1572,165 @@ def create_game_card(role, name, cards, desc):
     return FlexSendMessage(alt_text=f"{name} 開牌結果", contents=bubble)
 
 # --- 遊戲邏輯 ---
+TUI_TILES = [1, 2, 3, 4, 5, 6, 7, 8, 9, 0.5]
+NIU_SUITS = ['♠','♥','♦','♣']
+
+def new_deck(game_type='tui'):
+    deck = TUI_TILES * 4 if game_type == 'tui' else [(r, s) for s in NIU_SUITS for r in range(1, 14)]
+    random.shuffle(deck); return deck
+
 def get_tile_text(v):
     tiles_map = {1:"🀙",2:"🀚",3:"🀛",4:"🀜",5:"🀝",6:"🀞",7:"🀟",8:"🀠",9:"🀡",0.5:"🀆"}
     return tiles_map.get(v, "🀫")
-def calc_tui_score(t1, t2):
-    if t1 == t2: return "👑白板對" if t1==0.5 else f"🔥{int(t1)}對"
+def _tui_eval(t1, t2):
+    if t1 == t2: return (1000 if t1 == 0.5 else 100 + t1), ("👑白板對" if t1==0.5 else f"🔥{int(t1)}對")
     pts = (t1 + t2) % 10
-    return "💩癟十" if pts==0 else f"{int(pts) if pts==int(pts) else pts}點"
-def get_tui_value(t1, t2):
-    if t1 == t2: return 1000 if t1 == 0.5 else 100 + t1
-    score = (t1 + t2) % 10
-    return 0 if score == 0 else score
+    return (0 if pts == 0 else pts), ("💩癟十" if pts==0 else f"{int(pts) if pts==int(pts) else pts}點")
+# 推筒子只有 10x10 種組合，開機先算好
+TUI_TABLE = {(a, b): _tui_eval(a, b) for a in TUI_TILES for b in TUI_TILES}
+def calc_tui_score(t1, t2): return TUI_TABLE[(t1, t2)][1]
+def get_tui_value(t1, t2): return TUI_TABLE[(t1, t2)][0]
 def get_poker_text(card):
     rank, suit = card
     r_text = {1:'A', 11:'J', 12:'Q', 13:'K'}.get(rank, str(rank))
     return f"{suit}{r_text}"
-def calc_niu_score(hand):
-    values = [10 if r >= 10 else r for r, s in hand]
+def _niu_eval(values):
     total = sum(values); niu_point = -1 
     for i in range(5):
         for j in range(i+1, 5):
             rem = values[i] + values[j]
             if (total - rem) % 10 == 0:
-                np = rem % 10; np = 10 if np==0 else np
-                if np > niu_point: niu_point = np
+                pt = rem % 10; pt = 10 if pt==0 else pt
+                if pt > niu_point: niu_point = pt
     if niu_point == -1: return 0, "💩 無牛", 1
     elif niu_point == 10: return 100, "🎉 牛牛", 3
     else: return niu_point * 10, f"🐂 牛{niu_point}", 2 if niu_point >= 8 else 1
+# 妞妞只看 5 張點數 (10 以上算 10) 排序後的組合，共 2002 種，開機先算好
+NIU_TABLE = {key: _niu_eval(key) for key in itertools.combinations_with_replacement(range(1, 11), 5)}
+startup.mark('game_tables')
+def calc_niu_score(hand): return NIU_TABLE[tuple(sorted(10 if r >= 10 else r for r, s in hand))]
+
+# --- 🎲 蒙地卡羅模擬 (numpy 批次發牌，算莊家優勢和倍數分布) ---
+SIM_MAX_ROUNDS = 5_000_000
+SIM_BATCH = 100_000
+
+def sim_args(game_type, rounds, players, bet):
+    # 控制台傳來的可能是字串；不合理的直接擋掉，不要等丟進 numpy 才炸
+    if game_type not in ('tui', 'niu'): raise ValueError("game 只能是 tui 或 niu")
+    try: rounds, players, bet = int(rounds), int(players), int(bet)
+    except (TypeError, ValueError): raise ValueError("rounds / players / bet 要是整數")
+    if rounds <= 0 or players <= 0 or bet <= 0: raise ValueError("rounds / players / bet 要大於 0")
+    cn, size = (2, len(TUI_TILES) * 4) if game_type == 'tui' else (5, 52)
+    if cn * (players + 1) > size: raise ValueError(f"一副牌最多 {size // cn - 1} 位閒家")
+    return game_type, min(rounds, SIM_MAX_ROUNDS), players, bet
+
+def simulate_rounds(game_type, rounds, players, bet=100, seed=None, progress=None):
+    import numpy as np
+    game_type, rounds, players, bet = sim_args(game_type, rounds, players, bet)
+    cn = 2 if game_type == 'tui' else 5; deck = TUI_TILES * 4 if game_type == 'tui' else [r for r in range(1, 14)] * 4
+    rng = np.random.default_rng(seed)
+    if game_type == 'tui':
+        # 牌面轉成 0..9 的索引，用 10x10 表查值
+        card_idx = np.array([TUI_TILES.index(v) for v in deck])
+        value_tbl = np.array([[TUI_TABLE[(a, b)][0] for b in TUI_TILES] for a in TUI_TILES], dtype=float)
+    else:
+        # 5 張點數排序後當 11 進位數字，用陣列查分數/倍數
+        card_idx = np.minimum(np.array(deck), 10)
+        score_tbl = np.zeros(11 ** 5); mult_tbl = np.ones(11 ** 5, dtype=np.int64)
+        weights = 11 ** np.arange(5)
+        for key, (score, _, mult) in NIU_TABLE.items():
+            code = int(np.dot(key, weights)); score_tbl[code] = score; mult_tbl[code] = mult
+    profit = 0.0; profit_sq = 0.0; wins = losses = pushes = 0
+    b_mults = {}; p_mults = {}; done = 0
+    while done < rounds:
+        n = min(SIM_BATCH, rounds - done); done += n
+        order = rng.random((n, len(deck))).argsort(axis=1)[:, :cn * (players + 1)]
+        hands = card_idx[order].reshape(n, players + 1, cn)
+        if game_type == 'tui':
+            vals = value_tbl[hands[:, :, 0], hands[:, :, 1]]; mults = np.ones_like(vals, dtype=np.int64)
+        else:
+            code = (np.sort(hands, axis=2) * weights).sum(axis=2); vals = score_tbl[code]; mults = mult_tbl[code]
+        b_val, b_mult = vals[:, :1], mults[:, :1]; p_val, p_mult = vals[:, 1:], mults[:, 1:]
+        win = p_val > b_val; lose = p_val < b_val
+        # 莊家角度：閒輸收 bet*莊倍數，閒贏賠 bet*閒倍數
+        per_round = (np.where(lose, bet * b_mult, 0) - np.where(win, bet * p_mult, 0)).sum(axis=1)
+        profit += float(per_round.sum()); profit_sq += float((per_round.astype(float) ** 2).sum())
+        wins += int(lose.sum()); losses += int(win.sum()); pushes += int((~win & ~lose).sum())
+        for m, c in zip(*np.unique(b_mult, return_counts=True)): b_mults[int(m)] = b_mults.get(int(m), 0) + int(c)
+        for m, c in zip(*np.unique(p_mult, return_counts=True)): p_mults[int(m)] = p_mults.get(int(m), 0) + int(c)
+        if progress: progress(done)
+    hands_played = rounds * players; mean = profit / rounds
+    std_err = ((profit_sq / rounds - mean ** 2) / rounds) ** 0.5
+    return {"game": game_type, "rounds": rounds, "players": players, "bet": bet,
+            "banker_edge": round(profit / (hands_played * bet), 5), "banker_profit_per_round": round(mean, 3), "std_error": round(std_err, 3),
+            "banker_win_rate": round(wins / hands_played, 5), "banker_lose_rate": round(losses / hands_played, 5), "push_rate": round(pushes / hands_played, 5),
+            "banker_multipliers": {k: round(v / rounds, 5) for k, v in sorted(b_mults.items())},
+            "player_multipliers": {k: round(v / hands_played, 5) for k, v in sorted(p_mults.items())}}
+
+# 幾百萬局要跑好幾秒，不能卡在 web request 裡：跟公告一樣開背景工作，控制台用 job_id 查結果
+# 一次只跑一個 (numpy 會吃滿一顆 CPU)，其他的排隊
+class SimulationJob:
+    def __init__(self, game_type, rounds, players, bet, seed):
+        self.id = uuid.uuid4().hex[:8]; self.args = (game_type, rounds, players, bet, seed)
+        self.lock = threading.Lock(); self.done = 0; self.result = None; self.error = None
+        self.status = 'queued'; self.started = time.time(); self.finished = None
+
+    def progress(self, done):
+        with self.lock: self.done = done; self.status = 'running'
+
+    def snapshot(self):
+        with self.lock:
+            game_type, rounds, players, bet, seed = self.args
+            return {"job_id": self.id, "status": self.status, "game": game_type, "rounds": rounds, "players": players, "bet": bet, "seed": seed,
+                    "done": self.done, "elapsed": round((self.finished or time.time()) - self.started, 2), "result": self.result, "error": self.error}
+
+class Simulator:
+    def __init__(self, keep=20):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="simulate")
+        self.jobs = OrderedDict(); self.keep = keep; self.lock = threading.Lock()
+
+    def start(self, game_type, rounds, players, bet, seed=None):
+        import numpy   # 沒裝的話在這裡就回錯，不用等背景工作
+        job = SimulationJob(*sim_args(game_type, rounds, players, bet), seed)
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep: self.jobs.popitem(last=False)
+        self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock: return self.jobs.get(job_id)
+
+    def _run(self, job):
+        job.progress(0)
+        try: res = simulate_rounds(*job.args, progress=job.progress); err = None
+        except Exception as e: res = None; err = str(e); swallowed('simulate')
+        with job.lock: job.result = res; job.error = err; job.status = 'failed' if err else 'done'; job.finished = time.time()
+
+simulator = Simulator()
+
+def fetch_display_name(group_id, user_id):
+    if group_id: return name_cache.get((group_id, user_id), lambda: line_bot_api.get_group_member_profile(group_id, user_id).display_name)
+    return name_cache.get((None, user_id), lambda: line_bot_api.get_profile(user_id).display_name)
 
 def get_user_name(event, user_id=None):
     if not user_id: user_id = event.source.user_id
+    try: return fetch_display_name(event.source.group_id if event.source.type == 'group' else None, user_id)
+    except Exception: swallowed('user_name'); return "玩家"
+
+def prefetch_group_names(group_id):
+    # 需要認證/付費帳號才有成員清單 API，沒有就算了
     try:
-        if event.source.type == 'group': return line_bot_api.get_group_member_profile(event.source.group_id, user_id).display_name
-        else: return line_bot_api.get_profile(user_id).display_name
-    except: return "玩家"
+        start = None
+        while True:
+            res = line_bot_api.get_group_member_ids(group_id, start=start)
+            for uid in res.member_ids:
+                if name_cache.peek((group_id, uid)) is None:
+                    try: fetch_display_name(group_id, uid)
+                    except Exception: swallowed('name_prefetch_member')
+            start = res.next
+            if not start: break
+    except Exception: swallowed('name_prefetch')
 
 # --- 核心：自動結算邏輯 ---
 def check_and_settle_str(room):
@@ -190,18 +1744,16 @@ def check_and_settle_str(room):
         if game['game_type'] == 'niu':
             if "牛牛" in game['banker_desc']: b_mult = 3
             elif "牛8" in game['banker_desc'] or "牛9" in game['banker_desc']: b_mult = 2
-        ts = datetime.now().strftime("%H:%M")
-
         for pid in game['bets']:
             if pid not in game['player_results']: continue 
             p_res = game['player_results'][pid]; p_val = p_res['val']; p_name = p_res['name']; p_mult = p_res['mult']; base_amt = game['bets'][pid]['amount']
             
             if p_val > b_val:
                 final_amt = base_amt * p_mult; output_msg += f"✅ {p_name} 贏 ${final_amt}\n"
-                game['session_log'].append({'winner_id': pid, 'winner_name': p_name, 'loser_id': game['banker_id'], 'loser_name': b_name, 'amt': final_amt, 'desc': '閒贏', 'time': ts})
+                game['session'].record(pid, p_name, final_amt, '閒贏')
             elif p_val < b_val:
                 final_amt = base_amt * b_mult; output_msg += f"❌ {p_name} 輸 ${final_amt}\n"
-                game['session_log'].append({'winner_id': game['banker_id'], 'winner_name': b_name, 'loser_id': pid, 'loser_name': p_name, 'amt': final_amt, 'desc': '莊贏', 'time': ts})
+                game['session'].record(pid, p_name, -final_amt, '莊贏')
             else: output_msg += f"🤝 {p_name} 走水\n"
 
         # 重置小局
@@ -214,30 +1766,41 @@ def check_and_settle_str(room):
         return output_msg
     return None
 
-# --- 倒數計時器 ---
-def round_timer_thread(group_id, check_round_id):
-    time.sleep(15)
+# --- 倒數計時器 (莊家開牌後 15 秒提醒，再 5 秒判輸) ---
+def start_round_timer(group_id, check_round_id):
+    scheduler.schedule(ROUND_WARN_SECONDS, round_timer_warn, group_id, check_round_id, key=('round', group_id))
+
+def round_timer_warn(group_id, check_round_id):
+    with state.transaction(group_id): _round_timer_warn(group_id, check_round_id)
+
+def _round_timer_warn(group_id, check_round_id):
     room = get_room_data(group_id); game = room['game']
     if game['round_id'] != check_round_id or not game['banker_id'] or game['banker_card_val'] is None: return
     unplayed = [pid for pid in game['bets'] if pid not in game['played_users']]
     if unplayed:
-        try: line_bot_api.push_message(group_id, TextSendMessage(text=f"⏰ 還有 {len(unplayed)} 人未開牌！剩 5 秒判輸！"))
-        except: pass
+        try: line_bot_api.push_message(group_id, TextSendMessage(text=f"⏰ 還有 {len(unplayed)} 人未開牌！剩 {ROUND_EXPIRE_SECONDS} 秒判輸！"))
+        except Exception: swallowed('round_warn_push')
     else: return
-    time.sleep(5)
+    scheduler.schedule(ROUND_EXPIRE_SECONDS, round_timer_expire, group_id, check_round_id, key=('round', group_id))
+
+def round_timer_expire(group_id, check_round_id):
+    with state.transaction(group_id): _round_timer_expire(group_id, check_round_id)
+
+def _round_timer_expire(group_id, check_round_id):
+    room = get_room_data(group_id); game = room['game']
     if game['round_id'] != check_round_id or not game['banker_id']: return
-    missing_text = ""; ts = datetime.now().strftime("%H:%M"); has_penalty = False
+    missing_text = ""; has_penalty = False
     for pid, info in game['bets'].items():
         if pid not in game['played_users']:
             amt = info['amount']; p_name = info['name']
             missing_text += f"💤 {p_name} 超時未開 ❌ 輸 ${amt}\n"
-            game['session_log'].append({'winner_id': game['banker_id'], 'winner_name': game['banker_name'], 'loser_id': pid, 'loser_name': p_name, 'amt': amt, 'desc': '超時判輸', 'time': ts})
+            game['session'].record(pid, p_name, -amt, '超時判輸')
             game['played_users'].append(pid); has_penalty = True
     if has_penalty:
         result_str = check_and_settle_str(room)
         if result_str:
             try: line_bot_api.push_message(group_id, TextSendMessage(text=f"⌛ 時間到！\n{missing_text}{result_str}"))
-            except: pass
+            except Exception: swallowed('round_expire_push')
 
 @handler.add(JoinEvent)
 def handle_join(event):
@@ -246,264 +1809,376 @@ def handle_join(event):
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="✅ 授權成功！機器人已啟動。"))
     else:
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ 【未授權】請管理員在20秒內輸入「!開通」。"))
-        threading.Thread(target=lambda: (time.sleep(20), line_bot_api.leave_group(gid) if gid not in AUTHORIZED_GROUPS else None), daemon=True).start()
+        scheduler.schedule(JOIN_LEAVE_SECONDS, auto_leave_group, gid, key=('leave', gid))
+
+def auto_leave_group(gid):
+    if gid not in AUTHORIZED_GROUPS: line_bot_api.leave_group(gid)
+
+# --- 🧭 指令表：完整比對查 dict，前綴比對先用前 3 個字分桶，不再一路 if/elif ---
+class Command:
+    def __init__(self, names, func, prefix, kind, perm, deny):
+        self.name = names[0]; self.names = names; self.func = func; self.prefix = prefix
+        self.kind = kind; self.perm = perm; self.deny = deny
+        self.calls = self.denied = self.errors = 0; self.total = self.slowest = 0.0
+
+class CommandRegistry:
+    KEY_LEN = 3
+
+    def __init__(self):
+        self.exact = {}; self.prefixes = {}; self.all = []; self.lock = threading.Lock()
+
+    def register(self, names, func, prefix=False, kind='misc', perm=None, deny=None):
+        cmd = Command(names, func, prefix, kind, perm, deny); self.all.append(cmd)
+        for name in names:
+            if not prefix: self.exact[name] = cmd; continue
+            assert len(name) >= self.KEY_LEN, name
+            bucket = self.prefixes.setdefault(name[:self.KEY_LEN], []); bucket.append((name, cmd))
+            bucket.sort(key=lambda nc: len(nc[0]), reverse=True)
+        return cmd
+
+    def match(self, text):
+        cmd = self.exact.get(text)
+        if cmd: return cmd
+        for name, cmd in self.prefixes.get(text[:self.KEY_LEN], ()):
+            if text.startswith(name): return cmd
+        return None
+
+    def allowed(self, cmd, user_id):
+        if cmd.perm == 'admin': return user_id in ADMINS or user_id == OWNER_ID
+        if cmd.perm == 'owner': return user_id == OWNER_ID
+        return True
+
+    def run(self, cmd, event, text, user_id, source_id, room, reply_messages):
+        if not self.allowed(cmd, user_id):
+            with self.lock: cmd.denied += 1
+            if cmd.deny: reply_messages.append(TextSendMessage(text=cmd.deny))
+            return
+        started = time.time(); failed = False
+        try: cmd.func(event, text, user_id, source_id, room, reply_messages)
+        except Exception: failed = True; raise
+        finally:
+            spent = time.time() - started; metrics.observe('linebot_command_seconds', spent, command=cmd.name)
+            with self.lock:
+                cmd.calls += 1; cmd.errors += failed; cmd.total += spent; cmd.slowest = max(cmd.slowest, spent)
+
+    def stats(self):
+        with self.lock:
+            return {c.name: {"kind": c.kind, "calls": c.calls, "denied": c.denied, "errors": c.errors,
+                             "avg_ms": round(c.total / c.calls * 1000, 2) if c.calls else 0, "max_ms": round(c.slowest * 1000, 2)} for c in self.all}
+
+commands = CommandRegistry()
+
+def command(*names, prefix=False, kind='misc', perm=None, deny=None):
+    def decorator(func):
+        commands.register(names, func, prefix, kind, perm, deny); return func
+    return decorator
+
+# --- 權限指令 ---
+@command('!id')
+def cmd_id(event, text, user_id, source_id, room, reply_messages):
+    reply_messages.append(TextSendMessage(text=f"ID: {user_id}"))
+
+@command('!開通', kind='admin', perm='admin', deny="🚫 權限不足")
+def cmd_authorize(event, text, user_id, source_id, room, reply_messages):
+    AUTHORIZED_GROUPS.add(source_id); scheduler.cancel(('leave', source_id)); reply_messages.append(TextSendMessage(text="✅ 開通成功"))
+    if NAME_PREFETCH and event.source.type == 'group': threading.Thread(target=prefetch_group_names, args=(source_id,), daemon=True).start()
+
+@command('!黑名單 ', prefix=True, kind='admin', perm='admin')
+def cmd_blacklist(event, text, user_id, source_id, room, reply_messages):
+    if event.message.mention:
+        for m in event.message.mention.mentionees: BLACKLIST.add(m.user_id)
+        reply_messages.append(TextSendMessage(text="🚫 已封鎖標記對象"))
+    elif text.replace('!黑名單', '').strip():
+        BLACKLIST.add(text.replace('!黑名單', '').strip()); reply_messages.append(TextSendMessage(text="🚫 ID已封鎖"))
+
+@command('!解黑 ', prefix=True, kind='admin', perm='admin')
+def cmd_unblacklist(event, text, user_id, source_id, room, reply_messages):
+    target = text.replace('!解黑', '').strip()
+    if event.message.mention:
+         for m in event.message.mention.mentionees: 
+             if m.user_id in BLACKLIST: BLACKLIST.remove(m.user_id)
+         reply_messages.append(TextSendMessage(text="⭕ 已解鎖"))
+    elif target in BLACKLIST: BLACKLIST.remove(target); reply_messages.append(TextSendMessage(text="⭕ 已解鎖"))
+
+# --- 🇹🇭 泰文翻譯 ---
+@command('!泰 ', prefix=True, kind='translate')
+def cmd_to_thai(event, text, user_id, source_id, room, reply_messages):
+    try: reply_messages.append(TextSendMessage(text=f"🇹🇭 泰文：\n{translate_text(text[3:].strip(), 'th')[1]}"))
+    except Exception: swallowed('cmd_to_thai')
+
+@command('!指令')
+def cmd_help(event, text, user_id, source_id, room, reply_messages):
+    reply_text = "🤖 機器人指令表：\n-----------------\n🔒 授權\n👉 !id / !開通 (限管)\n👉 !黑名單 @人 (限老闆)\n\n🎰 流水局\n1. !搶莊 妞妞 (或 推)\n2. !下注 200\n3. !停 (鎖下注)\n4. !推 / !妞妞 (發牌)\n5. !戰績 (目前輸贏)\n6. !下莊 (亂喊罰一萬)\n\n🇹🇭 翻譯\n👉 !泰 [文] / 傳泰文自動翻\n\n💰 記帳\n👉 !記 / !還 / !查帳 / !一筆勾銷\n👉 !查帳 簡化 (最少轉帳) / !明細 [頁]\n👉 !抓 (防收回)\n👉 !金價 / !匯率 / !天氣\n-----------------\n㊗️黃燜雞楊梅店,黃金當鋪,JC Beauty生意興榮㊗️"
+    reply_messages.append(TextSendMessage(text=reply_text))
+
+# --- 🎰 賭場控制 ---
+@command('!搶莊', prefix=True, kind='game')
+def cmd_take_bank(event, text, user_id, source_id, room, reply_messages):
+    # 檢查有沒有指定遊戲
+    parts = text.split()
+    if len(parts) < 2 or parts[1] not in ['推', '妞妞']:
+        reply_messages.append(TextSendMessage(text="⚠️ 請指定遊戲！\n例如：!搶莊 推 或 !搶莊 妞妞"))
+    else:
+        mode = parts[1]
+        game_type = 'tui' if mode == '推' else 'niu'
+
+        # 初始化牌堆
+        room['deck'] = new_deck(game_type); scheduler.cancel(('round', source_id))
+
+        banker_name = get_user_name(event)
+        room['game'] = {
+            'banker_id': user_id, 'banker_name': banker_name, 'game_type': game_type, 
+            'banker_card_val': None, 'banker_desc': "", 'bets': {}, 'player_results': {}, 
+            'session': SessionBook(), 'played_users': [], 'betting_locked': False, 'session_locked': False, 
+            'allowed_players': set(), 'round_id': 0
+        }
+        reply_messages.append(TextSendMessage(text=f"👑 新局開始！玩「{mode}」\n莊家：{banker_name}\n🀄 牌已洗好\n👉 閒家請「!下注」"))
+
+@command('!下莊', kind='game')
+def cmd_leave_bank(event, text, user_id, source_id, room, reply_messages):
+    game = room['game']; user_name = get_user_name(event)
+    if not game['banker_id']: reply_messages.append(TextSendMessage(text="⚠️ 無莊家"))
+    elif user_id != game['banker_id'] and user_id not in ADMINS:
+        game['session'].record(user_id, user_name, -10000, '亂喊下莊罰款')
+        reply_messages.append(TextSendMessage(text=f"😡 {user_name} 亂喊下莊！罰 $10,000"))
+    else:
+        if not game['session']: reply_messages.append(TextSendMessage(text="⚠️ 無紀錄"))
+        else:
+            bid = game['banker_id']; bname = game['banker_name']
+            sum_txt = f"🧾 【總結算 (莊家: @{bname} )】\n----------------\n"; ments = [{"index": sum_txt.find(f"@{bname}"), "length": len(bname)+1, "userId": bid}]
+            for pid, pname, net in game['session'].standings():
+                if net > 0:
+                    s = len(sum_txt) + 8; sum_txt += f"🟥 莊家 給 @{pname} ${net}\n"; ments.append({"index": s, "length": len(pname)+1, "userId": pid})
+                    room['debt'].append(bname, pname, net, '賭局')
+                elif net < 0:
+                    s = len(sum_txt) + 3; sum_txt += f"🟩 @{pname} 給 莊家 ${abs(net)}\n"; ments.append({"index": s, "length": len(pname)+1, "userId": pid})
+                    room['debt'].append(pname, bname, abs(net), '賭局')
+            sum_txt += "\n✅ 已寫入公帳！\n㊗️黃燜雞楊梅店,黃金當鋪,JC Beauty生意興榮㊗️"
+            msg = TextSendMessage(text=sum_txt, mention={'mentionees': ments})
+            game['banker_id'] = None; game['session'] = SessionBook(); game['bets'] = {}
+            reply_messages.append(msg)
+
+@command('!戰績', kind='game')
+def cmd_standings(event, text, user_id, source_id, room, reply_messages):
+    game = room['game']
+    if not game['banker_id']: reply_messages.append(TextSendMessage(text="⚠️ 無莊家"))
+    elif not game['session']: reply_messages.append(TextSendMessage(text="⚠️ 無紀錄"))
+    else:
+        rows = sorted(game['session'].standings(), key=lambda r: r[2], reverse=True)
+        res = f"📈 目前戰績 (莊家: {game['banker_name']})\n----------------\n"
+        for _, pname, net in rows: res += f"{'🟥' if net > 0 else '🟩' if net < 0 else '⬜'} {pname} {'+' if net > 0 else ''}{net}\n"
+        b_net = -sum(r[2] for r in rows); res += f"----------------\n👑 莊家 {'+' if b_net > 0 else ''}{b_net}"
+        reply_messages.append(TextSendMessage(text=res))
+
+@command('!停', kind='game')
+def cmd_stop_betting(event, text, user_id, source_id, room, reply_messages):
+    game = room['game']
+    if not game['banker_id']: return
+    if user_id == game['banker_id'] or user_id in ADMINS: 
+        game['betting_locked'] = True
+        next_cmd = "!推" if game['game_type'] == 'tui' else "!妞妞"
+        reply_messages.append(TextSendMessage(text=f"🛑 停止下注！\n👉 請莊家輸入「{next_cmd}」開始發牌"))
+    else: reply_messages.append(TextSendMessage(text="🚫 你不是莊家"))
+
+@command('!下注', prefix=True, kind='game')
+def cmd_bet(event, text, user_id, source_id, room, reply_messages):
+    game = room['game']
+    if not game['banker_id']: reply_messages.append(TextSendMessage(text="⚠️ 無莊家"))
+    elif game['betting_locked']: reply_messages.append(TextSendMessage(text="🛑 下注已鎖定"))
+    elif user_id == game['banker_id']: reply_messages.append(TextSendMessage(text="⚠️ 莊家免下注"))
+    elif user_id in game['played_users']: reply_messages.append(TextSendMessage(text="⚠️ 本局已推過"))
+    elif game['session_locked'] and user_id not in game['allowed_players']:
+        wc = room['outsider_warn'].get(user_id, 0) + 1; room['outsider_warn'][user_id] = wc; name = get_user_name(event)
+        if wc == 1: reply_messages.append(TextSendMessage(text=f"⚠️ {name} 遊戲鎖定，路人勿擾(1次)"))
+        elif wc == 2:
+            game['session'].record(user_id, name, -200, '路人罰款')
+            reply_messages.append(TextSendMessage(text=f"😡 {name} 講不聽！罰款 $200"))
+        else: reply_messages.append(TextSendMessage(text=f"🤬 死小孩講不聽是不是！"))
+    else:
+        try:
+            parts = text.split(); amount = 100
+            if len(parts) > 1 and parts[1].isdigit(): amount = int(parts[1])
+            name = get_user_name(event); game['bets'][user_id] = {'amount': amount, 'name': name}
+            reply_messages.append(TextSendMessage(text=f"💰 {name} 下注 ${amount}"))
+        except Exception: swallowed('cmd_bet')
+
+@command('!推', '!妞妞', kind='game')
+def cmd_deal(event, text, user_id, source_id, room, reply_messages):
+    game = room['game']; deck = room['deck']; uid = user_id; name = get_user_name(event)
+    cmd = 'tui' if text == '!推' else 'niu'
+
+    if not game['banker_id']: reply_messages.append(TextSendMessage(text="⚠️ 請先 !搶莊"))
+    else:
+        if game['game_type'] != cmd:
+            reply_messages.append(TextSendMessage(text=f"🚫 本局是玩「{'推筒子' if game['game_type']=='tui' else '妞妞'}」！"))
+
+        elif uid in game['played_users']:
+            game['session'].record(uid, name, -100, '手賤罰款')
+            reply_messages.append(TextSendMessage(text=f"😡 {name} 重複開牌！罰 $100"))
+
+        elif uid != game['banker_id'] and uid not in game['bets']: 
+            reply_messages.append(TextSendMessage(text=f"⚠️ {name} 沒下注"))
+
+        else:
+            cn = 2 if game['game_type'] == 'tui' else 5
+            if len(deck) < cn:
+                room['deck'] = new_deck(game['game_type']); deck = room['deck']; reply_messages.append(TextSendMessage(text="🔀 牌不夠，自動洗牌！"))
+
+            hand = [deck.pop() for _ in range(cn)]; game['played_users'].append(uid)
+            if game['game_type'] == 'tui': val=get_tui_value(hand[0],hand[1]); desc=calc_tui_score(hand[0],hand[1]); cstr=f"{get_tile_text(hand[0])} {get_tile_text(hand[1])}"; mult=1
+            else: val, desc, mult = calc_niu_score(hand); cstr=" ".join([get_poker_text(c) for c in hand]); desc += f" (x{mult})" if mult>1 else ""
+
+            # Flex 卡片
+            reply_messages.append(create_game_card("👑 莊家" if uid==game['banker_id'] else "👤 閒家", name, cstr, desc))
+
+            if uid == game['banker_id']:
+                game['banker_card_val']=val; game['banker_desc']=f"{cstr} ({desc})"
+                start_round_timer(source_id, game['round_id'])
+            else:
+                game['player_results'][uid] = {'val': val, 'name': name, 'mult': mult}
+
+            settle_msg = check_and_settle_str(room)
+            if settle_msg: reply_messages.append(TextSendMessage(text=settle_msg)); scheduler.cancel(('round', source_id))
+
+# --- 💰 記帳 ---
+@command('!記 ', prefix=True, kind='ledger')
+def cmd_record_debt(event, text, user_id, source_id, room, reply_messages):
+    try:
+        p = text.split(); i = p.index('欠'); d, c, a = p[1], p[i+1], int(p[i+2]); n = " ".join(p[i+3:]) if len(p)>i+3 else "無"
+        room['debt'].append(d, c, a, n)
+        reply_messages.append(TextSendMessage(text=f"📝 已記錄：\n{d} 欠 {c} ${a}"))
+    except Exception: swallowed('cmd_record_debt')
+
+@command('!還 ', prefix=True, kind='ledger')
+def cmd_repay(event, text, user_id, source_id, room, reply_messages):
+    try:
+        p = text.split(); d, c, a = p[1], p[3], int(p[4])
+        room['debt'].append(d, c, -a, '還款')
+        reply_messages.append(TextSendMessage(text=f"💸 已扣除：\n{d} 還 {c} ${a}"))
+    except Exception: swallowed('cmd_repay')
+
+@command('!查帳', '!查帳 簡化', kind='ledger')
+def cmd_balance(event, text, user_id, source_id, room, reply_messages):
+    ledger = room['debt']
+    if not ledger: reply_messages.append(TextSendMessage(text="📭 無欠款紀錄"))
+    else:
+        simple = text.endswith('簡化')
+        rows = ledger.simplify() if simple else ledger.balances()
+        res = "📊 【最少轉帳 (誰付誰)】\n" if simple else "📊 【欠款總結】\n"
+        for d, c, t in rows: res += f"🔴 {d} 付 {c}：${t}\n" if simple else f"🔴 {d} 欠 {c}：${t}\n"
+        if not rows: res += "✅ 全部結清\n"
+        res += "\n🧾 近期明細：\n"
+        for r in ledger.entries[-5:]: res += f"[{r['time']}] {r['d']} 欠 {r['c']} ${abs(r['amt'])}\n"
+        reply_messages.append(TextSendMessage(text=res))
+
+@command('!明細', prefix=True, kind='ledger')
+def cmd_history(event, text, user_id, source_id, room, reply_messages):
+    arg = text.replace('!明細', '').strip(); page = int(arg) if arg.isdigit() else 1
+    if not room['debt']: reply_messages.append(TextSendMessage(text="📭 無欠款紀錄"))
+    else:
+        rows, pages = room['debt'].page(page, 10); page = min(max(1, page), pages)
+        res = f"🧾 帳本明細 (第 {page}/{pages} 頁)：\n"
+        for r in rows: res += f"[{r['time']}] {r['d']} {'還' if r['amt'] < 0 else '欠'} {r['c']} ${abs(r['amt'])} ({r['note']})\n"
+        reply_messages.append(TextSendMessage(text=res))
+
+@command('!一筆勾銷', kind='ledger')
+def cmd_clear_debt(event, text, user_id, source_id, room, reply_messages):
+    room['debt'].clear(); reply_messages.append(TextSendMessage(text="🧹 帳本已清空！"))
+
+@command('!抓')
+def cmd_unsent(event, text, user_id, source_id, room, reply_messages):
+    if not room.get('unsent_buffer'): reply_messages.append(TextSendMessage(text="👻 沒人收回"))
+    else:
+        for item in room['unsent_buffer']:
+            if item['type']=='text': reply_messages.append(TextSendMessage(text=f"🕵️ {item['sender']} 收回：\n{item['content']}"))
+            elif item['type']=='image': reply_messages.append(ImageSendMessage(original_content_url=item['content'], preview_image_url=item['content']))
+        room['unsent_buffer'].clear()
+
+# --- 📈 查價 ---
+@command('!金價', kind='scrape')
+def cmd_gold(event, text, user_id, source_id, room, reply_messages):
+    try:
+        price_str = quote_cache.get('gold', fetch_gold_price)
+        msg = f"💰 今日金價 (展寬/三井)：\n👉 1錢賣出價：NT$ {price_str}" if price_str else "⚠️ 抓不到價格。"
+    except Exception: swallowed('cmd_gold'); msg = "⚠️ 抓取金價失敗。"
+    reply_messages.append(TextSendMessage(text=msg))
+
+@command('!匯率', kind='scrape')
+def cmd_fx(event, text, user_id, source_id, room, reply_messages):
+    try:
+        rate = quote_cache.get('jpy', fetch_jpy_rate)
+        msg = f"🇯🇵 日幣 (JPY) 現金賣出：{rate}" if rate else "⚠️ 找不到日幣資料。"
+    except Exception: swallowed('cmd_fx'); msg = "⚠️ 抓取匯率失敗。"
+    reply_messages.append(TextSendMessage(text=msg))
+
+@command('!天氣', prefix=True, kind='scrape')
+def cmd_weather(event, text, user_id, source_id, room, reply_messages):
+    q = text.replace('!天氣', '').strip(); lat, lon, loc = 24.9442, 121.2192, "桃園平鎮"
+    if q:
+        try:
+            g = geocode(q)
+            if g: lat, lon, loc = g
+        except Exception: swallowed('geocode')
+    try:
+        temp = quote_cache.get(('weather', lat, lon), lambda: fetch_temperature(lat, lon))
+        reply_messages.append(TextSendMessage(text=f"🌤 {loc} 目前氣溫：{temp}°C"))
+    except Exception: swallowed('cmd_weather')
 
 @handler.add(MessageEvent, message=TextMessage)
 def handle_text_message(event):
     msg_id = event.message.id; text = event.message.text.strip()
     user_id = event.source.user_id
-    source_id = event.source.group_id if event.source.type == 'group' else event.source.user_id
+    source_id = event_source_id(event)
     
     if user_id in BLACKLIST: return 
-    room = get_room_data(source_id); message_store[msg_id] = text
+    room = get_room_data(source_id); message_store.put(source_id, msg_id, text)
     reply_messages = []
 
-    # --- 權限指令 ---
-    if text == '!id': reply_messages.append(TextSendMessage(text=f"ID: {user_id}"))
-    elif text == '!開通':
-        if user_id in ADMINS or user_id == OWNER_ID: AUTHORIZED_GROUPS.add(source_id); reply_messages.append(TextSendMessage(text="✅ 開通成功"))
-        else: reply_messages.append(TextSendMessage(text="🚫 權限不足"))
-    elif text.startswith('!黑名單 '):
-        if user_id in ADMINS:
-            if event.message.mention:
-                for m in event.message.mention.mentionees: BLACKLIST.add(m.user_id)
-                reply_messages.append(TextSendMessage(text="🚫 已封鎖標記對象"))
-            elif text.replace('!黑名單', '').strip():
-                BLACKLIST.add(text.replace('!黑名單', '').strip()); reply_messages.append(TextSendMessage(text="🚫 ID已封鎖"))
-    elif text.startswith('!解黑 '):
-        if user_id in ADMINS:
-            target = text.replace('!解黑', '').strip()
-            if event.message.mention:
-                 for m in event.message.mention.mentionees: 
-                     if m.user_id in BLACKLIST: BLACKLIST.remove(m.user_id)
-                 reply_messages.append(TextSendMessage(text="⭕ 已解鎖"))
-            elif target in BLACKLIST: BLACKLIST.remove(target); reply_messages.append(TextSendMessage(text="⭕ 已解鎖"))
-
-    # --- 🇹🇭 泰文自動翻譯 (強力修復版) ---
-    elif text.startswith('!泰 '):
-        try: reply_messages.append(TextSendMessage(text=f"🇹🇭 泰文：\n{translator.translate(text[3:].strip(), dest='th').text}"))
-        except: pass
-    elif not text.startswith('!'):
-        try:
-            # 直接翻譯成中文，不偵測，若來源是泰文就會回傳
-            res = translator.translate(text, dest='zh-tw')
-            if res.src == 'th' and res.text != text:
-                reply_messages.append(TextSendMessage(text=f"🇹🇭 泰翻中：\n{res.text}"))
-        except: pass
-
-    if text == '!指令':
-        reply_text = "🤖 機器人指令表：\n-----------------\n🔒 授權\n👉 !id / !開通 (限管)\n👉 !黑名單 @人 (限老闆)\n\n🎰 流水局\n1. !搶莊 妞妞 (或 推)\n2. !下注 200\n3. !停 (鎖下注)\n4. !推 / !妞妞 (發牌)\n5. !下莊 (亂喊罰一萬)\n\n🇹🇭 翻譯\n👉 !泰 [文] / 傳泰文自動翻\n\n💰 記帳\n👉 !記 / !還 / !查帳 / !一筆勾銷\n👉 !抓 (防收回)\n👉 !金價 / !匯率 / !天氣\n-----------------\n㊗️黃燜雞楊梅店,黃金當鋪,JC Beauty生意興榮㊗️"
-        reply_messages.append(TextSendMessage(text=reply_text))
-
-    # --- 🎰 賭場控制 ---
-    elif text.startswith('!搶莊'):
-        # 檢查有沒有指定遊戲
-        parts = text.split()
-        if len(parts) < 2 or parts[1] not in ['推', '妞妞']:
-            reply_messages.append(TextSendMessage(text="⚠️ 請指定遊戲！\n例如：!搶莊 推 或 !搶莊 妞妞"))
-        else:
-            mode = parts[1]
-            game_type = 'tui' if mode == '推' else 'niu'
-            
-            # 初始化牌堆
-            if game_type == 'tui': room['deck'] = [1, 2, 3, 4, 5, 6, 7, 8, 9, 0.5] * 4
-            else: room['deck'] = [(r, s) for s in ['♠','♥','♦','♣'] for r in range(1, 14)]
-            random.shuffle(room['deck'])
-            
-            banker_name = get_user_name(event)
-            room['game'] = {
-                'banker_id': user_id, 'banker_name': banker_name, 'game_type': game_type, 
-                'banker_card_val': None, 'banker_desc': "", 'bets': {}, 'player_results': {}, 
-                'session_log': [], 'played_users': [], 'betting_locked': False, 'session_locked': False, 
-                'allowed_players': set(), 'round_id': 0
-            }
-            reply_messages.append(TextSendMessage(text=f"👑 新局開始！玩「{mode}」\n莊家：{banker_name}\n🀄 牌已洗好\n👉 閒家請「!下注」"))
-
-    elif text == '!下莊':
-        game = room['game']; user_name = get_user_name(event)
-        if not game['banker_id']: reply_messages.append(TextSendMessage(text="⚠️ 無莊家"))
-        elif user_id != game['banker_id'] and user_id not in ADMINS:
-            ts = datetime.now().strftime("%H:%M")
-            game['session_log'].append({'winner_id': game['banker_id'], 'winner_name': game['banker_name'], 'loser_id': user_id, 'loser_name': user_name, 'amt': 10000, 'desc': '亂喊下莊罰款', 'time': ts})
-            reply_messages.append(TextSendMessage(text=f"😡 {user_name} 亂喊下莊！罰 $10,000"))
-        else:
-            if not game['session_log']: reply_messages.append(TextSendMessage(text="⚠️ 無紀錄"))
-            else:
-                p_bal = {}; bid = game['banker_id']; bname = game['banker_name']
-                for r in game['session_log']:
-                    wid, lid, amt = r['winner_id'], r['loser_id'], r['amt']
-                    if wid == bid: p_bal[lid] = {'n': r['loser_name'], 'v': p_bal.get(lid, {'v':0})['v'] - amt}
-                    elif lid == bid: p_bal[wid] = {'n': r['winner_name'], 'v': p_bal.get(wid, {'v':0})['v'] + amt}
-                sum_txt = f"🧾 【總結算 (莊家: @{bname} )】\n----------------\n"; ments = [{"index": sum_txt.find(f"@{bname}"), "length": len(bname)+1, "userId": bid}]
-                for pid, d in p_bal.items():
-                    net = d['v']; pname = d['n']
-                    if net > 0:
-                        s = len(sum_txt) + 8; sum_txt += f"🟥 莊家 給 @{pname} ${net}\n"; ments.append({"index": s, "length": len(pname)+1, "userId": pid})
-                        room['debt'].append({'d': bname, 'c': pname, 'amt': net, 'note': '賭局', 'time': datetime.now().strftime("%H:%M")})
-                    elif net < 0:
-                        s = len(sum_txt) + 3; sum_txt += f"🟩 @{pname} 給 莊家 ${abs(net)}\n"; ments.append({"index": s, "length": len(pname)+1, "userId": pid})
-                        room['debt'].append({'d': pname, 'c': bname, 'amt': abs(net), 'note': '賭局', 'time': datetime.now().strftime("%H:%M")})
-                sum_txt += "\n✅ 已寫入公帳！\n㊗️黃燜雞楊梅店,黃金當鋪,JC Beauty生意興榮㊗️"
-                msg = TextSendMessage(text=sum_txt, mention={'mentionees': ments})
-                game['banker_id'] = None; game['session_log'] = []; game['bets'] = {}
-                reply_messages.append(msg)
-
-    elif text == '!停':
-        game = room['game']
-        if not game['banker_id']: return
-        if user_id == game['banker_id'] or user_id in ADMINS: 
-            game['betting_locked'] = True
-            next_cmd = "!推" if game['game_type'] == 'tui' else "!妞妞"
-            reply_messages.append(TextSendMessage(text=f"🛑 停止下注！\n👉 請莊家輸入「{next_cmd}」開始發牌"))
-        else: reply_messages.append(TextSendMessage(text="🚫 你不是莊家"))
-
-    elif text.startswith('!下注'):
-        game = room['game']
-        if not game['banker_id']: reply_messages.append(TextSendMessage(text="⚠️ 無莊家"))
-        elif game['betting_locked']: reply_messages.append(TextSendMessage(text="🛑 下注已鎖定"))
-        elif user_id == game['banker_id']: reply_messages.append(TextSendMessage(text="⚠️ 莊家免下注"))
-        elif user_id in game['played_users']: reply_messages.append(TextSendMessage(text="⚠️ 本局已推過"))
-        elif game['session_locked'] and user_id not in game['allowed_players']:
-            wc = room['outsider_warn'].get(user_id, 0) + 1; room['outsider_warn'][user_id] = wc; name = get_user_name(event)
-            if wc == 1: reply_messages.append(TextSendMessage(text=f"⚠️ {name} 遊戲鎖定，路人勿擾(1次)"))
-            elif wc == 2:
-                game['session_log'].append({'winner_id': game['banker_id'], 'winner_name': game['banker_name'], 'loser_id': user_id, 'loser_name': name, 'amt': 200, 'desc': '路人罰款', 'time': datetime.now().strftime("%H:%M")})
-                reply_messages.append(TextSendMessage(text=f"😡 {name} 講不聽！罰款 $200"))
-            else: reply_messages.append(TextSendMessage(text=f"🤬 死小孩講不聽是不是！"))
-        else:
-            try:
-                parts = text.split(); amount = 100
-                if len(parts) > 1 and parts[1].isdigit(): amount = int(parts[1])
-                name = get_user_name(event); game['bets'][user_id] = {'amount': amount, 'name': name}
-                reply_messages.append(TextSendMessage(text=f"💰 {name} 下注 ${amount}"))
-            except: pass
-
-    elif text == '!推' or text == '!妞妞':
-        game = room['game']; deck = room['deck']; uid = user_id; name = get_user_name(event)
-        cmd = 'tui' if text == '!推' else 'niu'
-
-        if not game['banker_id']: reply_messages.append(TextSendMessage(text="⚠️ 請先 !搶莊"))
-        else:
-            if game['game_type'] != cmd:
-                reply_messages.append(TextSendMessage(text=f"🚫 本局是玩「{'推筒子' if game['game_type']=='tui' else '妞妞'}」！"))
-            
-            elif uid in game['played_users']:
-                game['session_log'].append({'winner_id': game['banker_id'], 'winner_name': game['banker_name'], 'loser_id': uid, 'loser_name': name, 'amt': 100, 'desc': '手賤罰款', 'time': datetime.now().strftime("%H:%M")})
-                reply_messages.append(TextSendMessage(text=f"😡 {name} 重複開牌！罰 $100"))
-            
-            elif uid != game['banker_id'] and uid not in game['bets']: 
-                reply_messages.append(TextSendMessage(text=f"⚠️ {name} 沒下注"))
-            
-            else:
-                cn = 2 if game['game_type'] == 'tui' else 5
-                if len(deck) < cn:
-                    if game['game_type']=='tui': room['deck'] = [1,2,3,4,5,6,7,8,9,0.5]*4
-                    else: room['deck'] = [(r,s) for s in ['♠','♥','♦','♣'] for r in range(1,14)]
-                    random.shuffle(room['deck']); deck = room['deck']; reply_messages.append(TextSendMessage(text="🔀 牌不夠，自動洗牌！"))
-                
-                hand = [deck.pop() for _ in range(cn)]; game['played_users'].append(uid)
-                if game['game_type'] == 'tui': val=get_tui_value(hand[0],hand[1]); desc=calc_tui_score(hand[0],hand[1]); cstr=f"{get_tile_text(hand[0])} {get_tile_text(hand[1])}"; mult=1
-                else: val, desc, mult = calc_niu_score(hand); cstr=" ".join([get_poker_text(c) for c in hand]); desc += f" (x{mult})" if mult>1 else ""
-
-                # Flex 卡片
-                reply_messages.append(create_game_card("👑 莊家" if uid==game['banker_id'] else "👤 閒家", name, cstr, desc))
-
-                if uid == game['banker_id']:
-                    game['banker_card_val']=val; game['banker_desc']=f"{cstr} ({desc})"
-                    threading.Thread(target=round_timer_thread, args=(source_id, game['round_id']), daemon=True).start()
-                else:
-                    game['player_results'][uid] = {'val': val, 'name': name, 'mult': mult}
-                
-                settle_msg = check_and_settle_str(room)
-                if settle_msg: reply_messages.append(TextSendMessage(text=settle_msg))
-
-    elif text.startswith('!記 '):
+    # 不是 ! 開頭就不查指令表；有泰文才送翻譯；兩者都先過洗版防護
+    if text.startswith('!'):
+        cmd = commands.match(text)
+        if cmd and (cmd.kind == 'game' and awaiting_play(room, user_id) or flood_gate(user_id, source_id, cmd.kind, reply_messages)): commands.run(cmd, event, text, user_id, source_id, room, reply_messages)
+    elif has_thai(text) and flood_gate(user_id, source_id, 'translate', reply_messages):
         try:
-            p = text.split(); i = p.index('欠'); d, c, a = p[1], p[i+1], int(p[i+2]); n = " ".join(p[i+3:]) if len(p)>i+3 else "無"
-            room['debt'].append({'d':d, 'c':c, 'amt':a, 'note':n, 'time':datetime.now().strftime("%H:%M")})
-            reply_messages.append(TextSendMessage(text=f"📝 已記錄：\n{d} 欠 {c} ${a}"))
-        except: pass
-    elif text.startswith('!還 '):
-        try:
-            p = text.split(); d, c, a = p[1], p[3], int(p[4])
-            room['debt'].append({'d':d, 'c':c, 'amt':-a, 'note':'還款', 'time':datetime.now().strftime("%H:%M")})
-            reply_messages.append(TextSendMessage(text=f"💸 已扣除：\n{d} 還 {c} ${a}"))
-        except: pass
-    elif text == '!查帳':
-        if not room['debt']: reply_messages.append(TextSendMessage(text="📭 無欠款紀錄"))
-        else:
-            s = {}; res = "📊 【欠款總結】\n"; hd = False
-            for r in room['debt']: k=(r['d'],r['c']); s[k]=s.get(k,0)+r['amt']
-            for (d,c),t in s.items():
-                if t>0: res+=f"🔴 {d} 欠 {c}：${t}\n"; hd=True
-            if not hd: res+="✅ 全部結清\n"
-            res += "\n🧾 近期明細：\n"
-            for r in room['debt'][-5:]: res += f"[{r['time']}] {r['d']} 欠 {r['c']} ${abs(r['amt'])}\n"
-            reply_messages.append(TextSendMessage(text=res))
-    elif text == '!一筆勾銷':
-        room['debt'].clear(); reply_messages.append(TextSendMessage(text="🧹 帳本已清空！"))
-    elif text == '!抓':
-        if not room.get('unsent_buffer'): reply_messages.append(TextSendMessage(text="👻 沒人收回"))
-        else:
-            for item in room['unsent_buffer']:
-                if item['type']=='text': reply_messages.append(TextSendMessage(text=f"🕵️ {item['sender']} 收回：\n{item['content']}"))
-                elif item['type']=='image': reply_messages.append(ImageSendMessage(original_content_url=item['content'], preview_image_url=item['content']))
-            room['unsent_buffer'] = []
-    elif text == '!金價':
-        try:
-            res = requests.get("https://999k.com.tw/", headers=headers, timeout=10); res.encoding = 'utf-8'
-            soup = BeautifulSoup(res.text, "html.parser"); price_str = None
-            for row in soup.find_all('tr'):
-                if "黃金賣出" in row.text.strip().replace('\n', '').replace(' ', ''):
-                    for td in row.find_all('td'):
-                        val = td.text.strip().replace(',', '')
-                        if val.isdigit() and len(val) >= 4: price_str = val; break
-                if price_str: break
-            msg = f"💰 今日金價 (展寬/三井)：\n👉 1錢賣出價：NT$ {price_str}" if price_str else "⚠️ 抓不到價格。"
-        except: msg = "⚠️ 抓取金價失敗。"
-        reply_messages.append(TextSendMessage(text=msg))
-    elif text == '!匯率':
-        try:
-            res = requests.get("https://rate.bot.com.tw/xrt?Lang=zh-TW", headers=headers, timeout=10)
-            soup = BeautifulSoup(res.text, "html.parser"); found = False
-            for row in soup.find('tbody').find_all('tr'):
-                if "JPY" in row.text:
-                    rate = row.find_all('td')[2].text.strip(); msg = f"🇯🇵 日幣 (JPY) 現金賣出：{rate}"; found=True; break
-            if not found: msg = "⚠️ 找不到日幣資料。"
-        except: msg = "⚠️ 抓取匯率失敗。"
-        reply_messages.append(TextSendMessage(text=msg))
-    elif text.startswith('!天氣'):
-        q = text.replace('!天氣', '').strip(); lat, lon, loc = 24.9442, 121.2192, "桃園平鎮"
-        if q:
-            try:
-                g = requests.get(f"https://geocoding-api.open-meteo.com/v1/search?name={q}&count=1&language=zh&format=json", headers=headers).json()
-                if "results" in g: lat,lon,loc = g["results"][0]["latitude"], g["results"][0]["longitude"], g["results"][0]["name"]
-            except: pass
-        try:
-            w = requests.get(f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true&timezone=auto", headers=headers).json()
-            reply_messages.append(TextSendMessage(text=f"🌤 {loc} 目前氣溫：{w['current_weather']['temperature']}°C"))
-        except: pass
+            # 若來源是泰文就會回傳
+            src, out = translate_text(text, 'zh-tw')
+            if src == 'th' and out != text:
+                reply_messages.append(TextSendMessage(text=f"🇹🇭 泰翻中：\n{out}"))
+        except Exception: swallowed('chat_translate')
 
     if reply_messages:
-        line_bot_api.reply_message(event.reply_token, reply_messages)
+        reply_with_overflow(event.reply_token, source_id, reply_messages)
 
 # --- 處理圖片/收回 ---
 @handler.add(MessageEvent, message=ImageMessage)
 def handle_image(event):
-    msg_id = event.message.id; content = line_bot_api.get_message_content(msg_id)
-    with open(os.path.join(static_tmp_path, f"{msg_id}.jpg"), 'wb') as fd:
-        for chunk in content.iter_content(): fd.write(chunk)
+    image_store.submit(event.message.id)
 
 @handler.add(UnsendEvent)
 def handle_unsend(event):
-    uid = event.unsend.message_id; room = get_room_data(event.source.group_id if event.source.type=='group' else event.source.user_id)
+    uid = event.unsend.message_id; room = get_room_data(event_source_id(event))
     sender = "有人"
-    try: sender = line_bot_api.get_group_member_profile(event.source.group_id, event.source.user_id).display_name if event.source.type=='group' else "有人"
-    except: pass
-    img = os.path.join(static_tmp_path, f"{uid}.jpg")
-    if 'unsent_buffer' not in room: room['unsent_buffer'] = []
-    if os.path.exists(img): room['unsent_buffer'].append({'sender':sender, 'type':'image', 'content':f"{FQDN}/static/tmp/{uid}.jpg"})
-    elif uid in message_store: room['unsent_buffer'].append({'sender':sender, 'type':'text', 'content':message_store[uid]})
+    try: sender = fetch_display_name(event.source.group_id, event.source.user_id) if event.source.type=='group' else "有人"
+    except Exception: swallowed('unsend_sender')
+    img = image_store.lookup(uid)
+    text = message_store.get(uid)
+    if img: room['unsent_buffer'].append({'sender':sender, 'type':'image', 'content':f"{FQDN}/static/tmp/{img}"})
+    elif text is not None: room['unsent_buffer'].append({'sender':sender, 'type':'text', 'content':text})
+
+# --- 🚀 開機收尾：背景執行緒 + 預熱重模組；lazy 模式下排到 WARMUP_DELAY 秒後，先讓 / 和 /callback 能回 ---
+def warm_up():
+    threading.Thread(target=quote_cache.run_forever, daemon=True).start()
+    threading.Thread(target=cleanup_images, daemon=True).start()
+    try:
+        line_bot_api.get(); translator.get()
+        if 'bs4' not in sys.modules:
+            started = time.perf_counter(); import bs4; startup.loaded('bs4', time.perf_counter() - started)
+    except Exception: swallowed('warm_up')
+
+startup.mark('commands')
+if LAZY_STARTUP: scheduler.schedule(WARMUP_DELAY, warm_up)
+else: warm_up(); startup.mark('warm_up')
+startup.ready()
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,269 @@
+"""Webhook 壓測：產生有簽章的 LINE 事件打 /callback，後端全部換成本機假服務。
+
+    python bench.py                          # 全部情境，預設併發
+    python bench.py -s round -c 32 -g 50     # 只跑流水局，32 併發、50 個群
+    python bench.py --api-delay 0.05         # 假 LINE API 每次延遲 50ms
+    python bench.py --sync                   # 同步模式：回應時間就包含 handler 處理時間
+
+p50/p95/p99 是 /callback 的回應時間；非同步模式下那只有驗簽 + 排隊，
+handler 實際處理時間另外在 h50/h95/h99 (每個事件)，圖片背景下載在 img95。
+"""
+import os
+import sys
+import re
+import json
+import time
+import hmac
+import base64
+import random
+import logging
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+SECRET = "bench-secret"
+os.environ.setdefault('CHANNEL_ACCESS_TOKEN', 'bench-token')
+os.environ.setdefault('CHANNEL_SECRET', SECRET)
+os.environ.setdefault('FLOOD_LIMITS', '')   # 壓測要量處理能力，洗版防護預設關掉
+
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.serving import make_server
+
+# --- 🧪 假服務：LINE Messaging API + 金價/匯率/天氣/翻譯 ---
+GOLD_HTML = "<table><tr><td>黃金賣出</td><td>9,876</td></tr></table>".encode()
+FX_HTML = "<table><tbody><tr><td>日圓 (JPY)</td><td>0.2</td><td>0.2150</td></tr></tbody></table>".encode()
+IMAGE_BYTES = os.urandom(256 * 1024)
+
+class FakeBackend(BaseHTTPRequestHandler):
+    delay = 0.0
+    calls = {}
+    lock = threading.Lock()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args): pass
+
+    def _send(self, body, ctype="application/json", code=200):
+        if isinstance(body, (dict, list)): body = json.dumps(body).encode()
+        self.send_response(code); self.send_header("Content-Type", ctype); self.send_header("Content-Length", str(len(body))); self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method):
+        url = urlparse(self.path); path = url.path; host = self.headers.get("X-Bench-Host", "api.line.me")
+        key = f"{method} {host}{re.sub(r'/(?:[UCR][0-9a-f]{32}|[0-9]+)(?=/|$)', '/{id}', path)}"
+        with self.lock: self.calls[key] = self.calls.get(key, 0) + 1
+        if self.delay: time.sleep(self.delay)
+        n = int(self.headers.get("Content-Length") or 0)
+        if n: self.rfile.read(n)
+        if host == "999k.com.tw": return self._send(GOLD_HTML, "text/html; charset=utf-8")
+        if host == "rate.bot.com.tw": return self._send(FX_HTML, "text/html; charset=utf-8")
+        if host == "geocoding-api.open-meteo.com": return self._send({"results": [{"latitude": 25.03, "longitude": 121.56, "name": parse_qs(url.query).get("name", ["?"])[0]}]})
+        if host == "api.open-meteo.com": return self._send({"current_weather": {"temperature": 26.5}})
+        if host == "translate": return self._send({"src": "th", "text": "（譯）" + parse_qs(url.query).get("q", [""])[0]})
+        if path.endswith("/content"): return self._send(IMAGE_BYTES, "image/jpeg")
+        if "/member/" in path or path.startswith("/v2/bot/profile/"): return self._send({"displayName": "玩家" + path.rsplit("/", 1)[-1][-4:], "userId": path.rsplit("/", 1)[-1]})
+        if path.endswith("/members/ids"): return self._send({"memberIds": []})
+        return self._send({})
+
+    def do_GET(self): self._route("GET")
+    def do_POST(self): self._route("POST")
+
+class RedirectAdapter(HTTPAdapter):
+    # 把爬蟲的外部網址導到假服務，原本的 host 放在 header 讓假服務分辨
+    def __init__(self, base, **kwargs):
+        super().__init__(**kwargs); self.base = base
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url); request.headers["X-Bench-Host"] = url.hostname
+        request.url = f"{self.base}{url.path}{'?' + url.query if url.query else ''}"
+        return super().send(request, **kwargs)
+
+class FakeTranslation:
+    def __init__(self, src, text): self.src, self.text = src, text
+
+def wire_app(app, fake_base):
+    app.line_bot_api.endpoint = fake_base; app.line_bot_api.data_endpoint = fake_base
+    for host in ("https://999k.com.tw", "https://rate.bot.com.tw", "https://geocoding-api.open-meteo.com", "https://api.open-meteo.com"):
+        app.http.mount(host, RedirectAdapter(fake_base))
+    session = requests.Session()
+    def translate(text, dest='zh-tw'):
+        d = session.get(f"{fake_base}/translate", params={"q": text}, headers={"X-Bench-Host": "translate"}, timeout=5).json()
+        return FakeTranslation(d["src"], d["text"])
+    app.translator.translate = translate
+
+# --- 📨 事件產生器 ---
+class EventFactory:
+    def __init__(self): self.seq = 0; self.lock = threading.Lock()
+
+    def _next(self):
+        with self.lock: self.seq += 1; return self.seq
+
+    def _base(self, etype, gid, uid, **extra):
+        n = self._next()
+        ev = {"type": etype, "mode": "active", "timestamp": int(time.time() * 1000), "webhookEventId": f"01BENCH{n:019d}",
+              "deliveryContext": {"isRedelivery": False}, "source": {"type": "group", "groupId": gid, "userId": uid}}
+        ev.update(extra); return ev
+
+    def text(self, gid, uid, text):
+        n = self._next(); return self._base("message", gid, uid, replyToken=f"r{n}", message={"type": "text", "id": f"{n}", "text": text})
+
+    def image(self, gid, uid):
+        n = self._next(); return self._base("message", gid, uid, replyToken=f"r{n}", message={"type": "image", "id": f"{n}", "contentProvider": {"type": "line"}})
+
+    def unsend(self, gid, uid, msg_id): return self._base("unsend", gid, uid, unsend={"messageId": msg_id})
+    def join(self, gid): return self._base("join", gid, None, replyToken=f"r{self._next()}") | {"source": {"type": "group", "groupId": gid}}
+
+def sign(body):
+    return base64.b64encode(hmac.new(SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+def uid(i): return "U%032x" % i
+def gid(i): return "C%032x" % i
+
+# 每個情境回傳 streams：每條 stream 依序送 (同一群內要保持順序)，stream 之間併發
+def scenario_chat(f, groups, players):
+    lines = ["今天吃什麼", "哈哈哈", "สวัสดีครับ", "ขอบคุณ", "好喔"]
+    return [[[f.text(gid(g), uid(p), random.choice(lines))] for p in range(players) for _ in range(5)] for g in range(groups)]
+
+def scenario_commands(f, groups, players):
+    cmds = ["!id", "!指令", "!金價", "!匯率", "!天氣 台北", "!記 阿明 欠 阿華 100", "!查帳", "!泰 你好"]
+    return [[[f.text(gid(g), uid(p), c)] for p in range(players) for c in cmds] for g in range(groups)]
+
+def scenario_round(f, groups, players):
+    streams = []
+    for g in range(groups):
+        G, banker = gid(1000 + g), uid(0); s = [[f.text(G, banker, "!搶莊 推")]]
+        s += [[f.text(G, uid(p), f"!下注 {100 * p}")] for p in range(1, players + 1)]
+        s += [[f.text(G, banker, "!停")], [f.text(G, banker, "!推")]]
+        s += [[f.text(G, uid(p), "!推")] for p in range(1, players + 1)]
+        s += [[f.text(G, banker, "!戰績")], [f.text(G, banker, "!下莊")], [f.text(G, banker, "!查帳")]]
+        streams.append(s)
+    return streams
+
+def scenario_images(f, groups, players):
+    streams = []
+    for g in range(groups):
+        G = gid(2000 + g); imgs = [f.image(G, uid(p)) for p in range(players)]
+        streams.append([[ev] for ev in imgs] + [[f.unsend(G, uid(0), ev["message"]["id"])] for ev in imgs] + [[f.text(G, uid(0), "!抓")]])
+    return streams
+
+def scenario_joins(f, groups, players):
+    return [[[f.join(gid(3000 + g))]] for g in range(groups)]
+
+SCENARIOS = {"chat": scenario_chat, "commands": scenario_commands, "round": scenario_round, "images": scenario_images, "joins": scenario_joins}
+
+# --- 📊 量測 ---
+class HandlerTimer:
+    # 包住 dispatch_event 和圖片下載工作，記下每一個事件真正的處理時間 (依目前情境分開)
+    def __init__(self): self.lock = threading.Lock(); self.scenario = None; self.events = {}; self.images = {}
+
+    def _record(self, bucket, seconds):
+        with self.lock: bucket.setdefault(self.scenario, []).append(seconds)
+
+    def install(self, bot):
+        dispatch, capture = bot.dispatch_event, bot.image_store._capture
+        def timed_dispatch(event):
+            started = time.perf_counter()
+            try: return dispatch(event)
+            finally: self._record(self.events, time.perf_counter() - started)
+        def timed_capture(msg_id):
+            started = time.perf_counter()
+            try: return capture(msg_id)
+            finally: self._record(self.images, time.perf_counter() - started)
+        bot.dispatch_event = timed_dispatch; bot.image_store._capture = timed_capture
+
+    def take(self, scenario):
+        with self.lock: return sorted(self.events.pop(scenario, [])), sorted(self.images.pop(scenario, []))
+
+timer = HandlerTimer()
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as fd:
+            for line in fd:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) / 1024
+    except OSError: pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def pct(sorted_vals, p):
+    if not sorted_vals: return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(round(p / 100 * (len(sorted_vals) - 1))))]
+
+def wait_drained(app, timeout=60):
+    # 等 webhook 佇列和圖片背景下載都做完
+    pool = app.event_pool; started = time.time()
+    while time.time() - started < timeout:
+        snap = pool.snapshot() if pool else None
+        queued = snap is not None and (snap["processed"] + snap["rejected"] < snap["enqueued"] or any(snap["depth"]))
+        if not queued and not app.image_store.stats()["downloading"]: break
+        time.sleep(0.01)
+    return time.time() - started
+
+def run_scenario(name, streams, url, concurrency):
+    latencies = []; statuses = {}; lock = threading.Lock(); local = threading.local()
+
+    def send_stream(stream):
+        session = getattr(local, "session", None) or requests.Session(); local.session = session
+        for events in stream:
+            body = json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False)
+            started = time.perf_counter()
+            res = session.post(url, data=body.encode(), headers={"X-Line-Signature": sign(body), "Content-Type": "application/json"})
+            spent = time.perf_counter() - started
+            with lock: latencies.append(spent); statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+
+    rss_before = rss_mb(); started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex: list(ex.map(send_stream, streams))
+    elapsed = time.perf_counter() - started
+    return {"scenario": name, "requests": len(latencies), "elapsed": elapsed, "statuses": statuses, "latencies": sorted(latencies), "rss_before": rss_before}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS), help="可重複；預設全部")
+    ap.add_argument("-c", "--concurrency", type=int, default=16)
+    ap.add_argument("-g", "--groups", type=int, default=20)
+    ap.add_argument("-p", "--players", type=int, default=5)
+    ap.add_argument("--api-delay", type=float, default=0.0, help="假服務每次回應延遲秒數")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--sync", action="store_true", help="ASYNC_WEBHOOK=0：回應時間包含 handler")
+    ap.add_argument("--json", action="store_true", help="輸出 JSON")
+    args = ap.parse_args()
+    random.seed(args.seed)
+    if args.sync: os.environ["ASYNC_WEBHOOK"] = "0"
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    FakeBackend.delay = args.api_delay
+    fake = ThreadingHTTPServer(("127.0.0.1", 0), FakeBackend); threading.Thread(target=fake.serve_forever, daemon=True).start()
+    fake_base = f"http://127.0.0.1:{fake.server_port}"
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as bot
+    wire_app(bot, fake_base); timer.install(bot)
+    server = make_server("127.0.0.1", 0, bot.app, threaded=True); threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/callback"
+
+    factory = EventFactory(); results = []
+    for name in args.scenario or list(SCENARIOS):
+        timer.scenario = name
+        res = run_scenario(name, SCENARIOS[name](factory, args.groups, args.players), url, args.concurrency)
+        res["drain"] = wait_drained(bot); res["rss_after"] = rss_mb(); res["handler"], res["images"] = timer.take(name); results.append(res)
+
+    report = []
+    for r in results:
+        lat, hd, img = r["latencies"], r["handler"], r["images"]
+        report.append({"scenario": r["scenario"], "requests": r["requests"], "rps": round(r["requests"] / r["elapsed"], 1),
+                       "p50_ms": round(pct(lat, 50) * 1000, 2), "p95_ms": round(pct(lat, 95) * 1000, 2), "p99_ms": round(pct(lat, 99) * 1000, 2),
+                       "events": len(hd), "handler_p50_ms": round(pct(hd, 50) * 1000, 2), "handler_p95_ms": round(pct(hd, 95) * 1000, 2),
+                       "handler_p99_ms": round(pct(hd, 99) * 1000, 2), "images": len(img), "image_p95_ms": round(pct(img, 95) * 1000, 2),
+                       "drain_s": round(r["drain"], 3), "rss_delta_mb": round(r["rss_after"] - r["rss_before"], 2), "statuses": r["statuses"]})
+    if args.json: print(json.dumps({"sync": args.sync, "results": report, "backend_calls": FakeBackend.calls}, ensure_ascii=False, indent=2)); return
+    print(f"{'scenario':<10}{'reqs':>7}{'rps':>9}{'p50ms':>9}{'p95ms':>9}{'p99ms':>9}{'h50ms':>9}{'h95ms':>9}{'h99ms':>9}{'img95':>9}{'drain s':>9}{'ΔRSS MB':>9}  status")
+    for r in report:
+        print(f"{r['scenario']:<10}{r['requests']:>7}{r['rps']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{r['handler_p50_ms']:>9}{r['handler_p95_ms']:>9}"
+              f"{r['handler_p99_ms']:>9}{r['image_p95_ms'] if r['images'] else '-':>9}{r['drain_s']:>9}{r['rss_delta_mb']:>9}  {r['statuses']}")
+    print(f"\nbackend calls: {dict(sorted(FakeBackend.calls.items()))}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# app 在 import 時就讀環境變數、開 DB，所以要在任何測試 import 它之前設好
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.update(CHANNEL_ACCESS_TOKEN='test', CHANNEL_SECRET='test', ASYNC_WEBHOOK='0', FLOOD_LIMITS='', LAZY_STARTUP='1',
+                  STATE_BACKEND='sqlite', STATE_PATH=os.path.join(tempfile.mkdtemp(prefix='linebot-test-'), 'state.db'))
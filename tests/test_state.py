@@ -0,0 +1,105 @@
+import itertools
+import time
+
+import pytest
+from linebot.models import MessageEvent
+
+import app
+
+ids = itertools.count(1)
+
+class Profile:
+    def __init__(self, user_id): self.display_name = user_id
+
+@pytest.fixture
+def replies(monkeypatch):
+    sent = []
+    def reply(token, messages): sent.extend(m.text for m in (messages if isinstance(messages, list) else [messages]))
+    monkeypatch.setattr(app.line_bot_api, 'reply_message', reply)
+    monkeypatch.setattr(app.line_bot_api, 'push_message', lambda to, messages: None)
+    monkeypatch.setattr(app.line_bot_api, 'get_group_member_profile', lambda gid, uid: Profile(uid))
+    monkeypatch.setattr(app.line_bot_api, 'get_profile', lambda uid: Profile(uid))
+    return sent
+
+def text_event(text, source_id, user_id='U1', kind='group'):
+    n = next(ids); key = {'group': 'groupId', 'room': 'roomId'}[kind]
+    return MessageEvent.new_from_json_dict({
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000), "webhookEventId": f"E{n}",
+        "deliveryContext": {"isRedelivery": False}, "replyToken": f"R{n}",
+        "source": {"type": kind, key: source_id, "userId": user_id}, "message": {"type": "text", "id": f"M{n}", "text": text}})
+
+def say(text, source_id, **kw):
+    app.dispatch_event(text_event(text, source_id, **kw))
+
+def other_worker():
+    # 同一個 DB 檔再開一份 state，等於另一個 gunicorn worker
+    return app.SQLiteState(app.STATE_PATH)
+
+def test_ledger_reaches_other_worker(replies):
+    for amt in (10, 20, 30): say(f'!記 A 欠 B {amt} x', 'G-sync')
+    other = other_worker()
+    assert other.get_room('G-sync')['debt'].balances() == [('A', 'B', 60)]
+    assert len(other.get_room('G-sync')['debt']) == 3
+
+def test_reload_after_other_worker_writes(replies, monkeypatch):
+    say('!記 A 欠 B 50 x', 'G-reload'); other = other_worker()
+    with monkeypatch.context() as m:
+        m.setattr(app, 'state', other); say('!還 A 還 B 20', 'G-reload')
+    say('!查帳', 'G-reload', user_id='U2')
+    assert '🔴 A 欠 B：$30' in replies[-1]
+    assert app.state.rooms['G-reload']['debt'].balances() == [('A', 'B', 30)]
+
+def test_clear_rewrites_ledger_table(replies):
+    say('!記 A 欠 B 5 x', 'G-clear'); other = other_worker()
+    say('!一筆勾銷', 'G-clear'); say('!記 C 欠 D 7 y', 'G-clear')
+    other._reload('G-clear')
+    assert other.rooms['G-clear']['debt'].balances() == [('C', 'D', 7)]
+    rows = app.state._conn().execute("SELECT seq FROM ledger WHERE room_id=?", ('G-clear',)).fetchall()
+    assert rows == [(0,)]
+
+def test_unchanged_room_is_not_rewritten(replies):
+    say('hello', 'G-noop'); writes = app.state.writes
+    for text in ('hi', '!查帳', 'yo'): say(text, 'G-noop')
+    assert app.state.writes == writes
+
+def test_room_source_is_stored_under_room_id(replies):
+    say('!記 X 欠 Y 5', 'R-room', kind='room')
+    other = other_worker()
+    assert 'R-room' in other.room_ids()
+    assert other.get_room('R-room')['debt'].balances() == [('X', 'Y', 5)]
+
+def test_claim_event_is_shared_between_workers():
+    other = other_worker(); now = time.time()
+    assert app.state.claim_event('dup-1', now - 60)
+    assert not app.state.claim_event('dup-1', now - 60)
+    assert not other.claim_event('dup-1', now - 60)
+    # 過期的 id 可以再被認領
+    assert other.claim_event('dup-1', time.time() + 1)
+    app.state.release_event('dup-1')
+    assert app.state.claim_event('dup-1', now - 60)
+
+def test_message_store_trims_per_room_and_total(tmp_path):
+    st = app.SQLiteState(str(tmp_path / 'msgs.db')); store = app.SQLiteMessageStore(st, 3, 5, 3600)
+    for i in range(10): store.put('G1', f'm{i}', f'text {i}')
+    assert [m in store for m in ('m6', 'm7', 'm8', 'm9')] == [False, True, True, True]
+    assert store.get('m9') == 'text 9'
+    # 全域上限每 200 筆才清一次
+    for i in range(190): store.put(f'G{i % 4 + 2}', f'n{i}', 'x')
+    assert len(store) == 5
+
+def test_ledger_simplify_settles_in_fewest_transfers():
+    ledger = app.Ledger()
+    ledger.append('A', 'B', 100, ''); ledger.append('B', 'C', 100, ''); ledger.append('C', 'A', 30, '')
+    assert sorted(ledger.balances()) == [('A', 'B', 100), ('B', 'C', 100), ('C', 'A', 30)]
+    assert ledger.simplify() == [('A', 'C', 70)]
+    ledger.append('A', 'B', -100, '還款'); ledger.append('B', 'C', -100, '還款'); ledger.append('C', 'A', -30, '還款')
+    assert ledger.balances() == [] and ledger.simplify() == []
+
+def test_ledger_page_is_newest_first():
+    ledger = app.Ledger()
+    for i in range(25): ledger.append('A', 'B', i + 1, str(i))
+    rows, pages = ledger.page(1, 10)
+    assert pages == 3 and [r['note'] for r in rows] == [str(i) for i in range(24, 14, -1)]
+    rows, _ = ledger.page(3, 10)
+    assert [r['note'] for r in rows] == ['4', '3', '2', '1', '0']
+    assert ledger.page(99, 10)[0] == rows